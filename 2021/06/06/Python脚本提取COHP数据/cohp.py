@@ -3,159 +3,487 @@
 # Written by Yafei Jiang                                                              ##
 # Email: jiangyafei730@163.com                                                        ##
 # Usage: python cohp.py                                                               ##
+# Usage: python cohp.py -q "all all;3d 3d;4s 4s" -o cohp_bulk  (no prompt or figure)  ##
+# Usage: python cohp.py -Q queries.txt  (each line: selections such as 3d 2p;4s 2s)   ##
+# Usage: python cohp.py -q "3d 2p" -e=0,-0.5,-8:0  (ICOHP up to energies or windows)  ##
+# Usage: python cohp.py -d "Fe*O*" -q "3d 2p;4s 2s" -j 8 -o cmp  (many structures)    ##
+# Usage: python cohp.py -Q queries.txt -p png,pdf  (one figure for each line, no GUI) ##
 # update including spin unpolarization condition                                      ##
+# Usage: python cohp.py -q "3d 2p" -w=-8:5  (read only window and selected columns)   ##
+# Usage: python cohp.py -b -o FeO  (ICOHP matrix of atom pairs, edges, element pairs) ##
+# Usage: python cohp.py --broaden 0.1 --energy-grid=-8:5:1301  (Gaussian, resampled)  ##
+# Usage: python cohp.py -x  (one window: type selections in text box, lines updated)  ##
+# Note: parsed data is cached in COHPCAR.lobster.npy and COHPCAR.lobster.json         ##
+# Note: COHPCAR.lobster.gz (.xz .bz2 .zst) is read directly without decompressed file ##
+# (and not cached in uncompressed .npy sidecar unless --cache-compressed is given)    ##
 ########################################################################################
+import os
+import re
+import time
+import io
+import glob
+import gzip
+import bz2
+import lzma
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import numpy as np
-from matplotlib import pyplot as plt
-import pandas as pd 
-from pandas import DataFrame
 
 
-def process_file(file_name):
-    '''Loading COHPCAR.lobster file and return numbers, titles and cohp data of interactions'''
-    #file_name="COHPCAR.lobster"
-    file_out=open(file_name,'r')
-    lines=file_out.readlines()
-    print("Reading COHPCAR.lobster...")
-    num = int(lines[1].split()[0])
-    spin = int(lines[1].split()[1])
-    grid = int(lines[1].split()[2])
+def compression(file_name):
+    '''Return compression of file detected by magic bytes: gzip, xz, bz2, zstd or None'''
+    with open(file_name, 'rb') as f:
+        magic = f.read(6)
+    if magic[:2] == b"\x1f\x8b":
+        return "gzip"
+    if magic == b"\xfd7zXZ\x00":
+        return "xz"
+    if magic[:3] == b"BZh":
+        return "bz2"
+    if magic[:4] == b"\x28\xb5\x2f\xfd":
+        return "zstd"
+    return None
+
+
+def open_cohpcar(file_name):
+    '''Return binary file object of COHPCAR.lobster which is decompressed while it is read
+       if it is compressed by gzip, xz, bzip2 or zstd'''
+    method = compression(file_name)
+    if method == "gzip":
+        return gzip.open(file_name, 'rb')
+    if method == "xz":
+        return lzma.open(file_name, 'rb')
+    if method == "bz2":
+        return bz2.open(file_name, 'rb')
+    if method == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise SystemExit("zstandard is required to read %s: pip install zstandard" % file_name)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(file_name, 'rb')), 1 << 22)
+    return open(file_name, 'rb')
+
+
+def cohpcar_file(directory):
+    '''Return COHPCAR.lobster in directory, or its compressed file if it is not there'''
+    for ext in ("", ".gz", ".xz", ".bz2", ".zst"):
+        file_name = os.path.join(directory, "COHPCAR.lobster" + ext)
+        if os.path.isfile(file_name):
+            return file_name
+    return os.path.join(directory, "COHPCAR.lobster")
+
+
+def read_header(f):
+    '''Read header lines of COHPCAR.lobster from file object f and return numbers, spin, grid and titles'''
+    f.readline()
+    num, spin, grid = map(int, f.readline().split()[:3])
+    lines = [f.readline().decode() for i in range(num)]
     titles=["Average"]
-    titles.append(lines[3].split("(")[0].split(":")[1])
-    for i in range(num-2):
-        linesplit=lines[i+4].split("[")
+    titles.append(lines[1].split("(")[0].split(":")[1])
+    for line in lines[2:]:
+        if "[" not in line:  # interaction of another atom pair
+            titles.append(line.split("(")[0].split(":")[1])
+            continue
+        linesplit=line.split("[")
         atom1=linesplit[1].split("]")[0]
         atom2=linesplit[2].split("]")[0]
         titles.append([atom1,atom2])
-    
-    data = []    
-    for i in range(grid):
-        data.append(list(map(float,lines[num+2+i].split())))
-    
-    cohp = np.array(data).T
-    print(len(cohp))
-    print("Including cohp of "+str(num))
-    print(titles)
-    # energy = cohp[0]
-    print("COHP data is loaded.")
-    return num,titles,cohp
+    return num,spin,grid,titles
 
 
-def get_cohp(num,titles,cohp,orbital):
-    '''readin interaction orbital paris and return cohp and icohp data of orbital paris'''
-    if type(orbital[0]) is not list and type(orbital[1]) is not list:
-        for i in range(num):
-            if orbital[0] == "all":
-                index0 = 1
-            elif orbital[0] in titles[i][0] and orbital[1] in titles[i][1]:
-                index0 = i
-                break
-            else:
+def read_data(f, grid, ncol, chunk=1<<22):
+    '''Read grid rows of ncol numbers from file object f in chunks of bytes into a preallocated array'''
+    data = np.empty(grid * ncol)
+    n = 0
+    rest = b""
+    while n < data.size:
+        block = f.read(chunk)
+        if not block:
+            block, rest = rest, b""
+        else:
+            block = rest + block
+            cut = block.rfind(b"\n") + 1  # parse complete lines only
+            if cut == 0:
+                rest = block
                 continue
+            block, rest = block[:cut], block[cut:]
+        if not block:
+            break
+        values = np.fromstring(block.decode(), sep=" ")
+        values = values[:data.size - n]
+        data[n:n+len(values)] = values
+        n += len(values)
+    if n < data.size:
+        raise ValueError("COHP data is incomplete: %d of %d numbers are read." % (n, data.size))
+    return data.reshape(grid, ncol)
+
+
+cache_version = "1"  # change it when format of sidecar cache is changed
+
+
+def file_hash(file_name, blocksize=1 << 24):
+    '''Return content hash of file'''
+    h = hashlib.blake2b(cache_version.encode(), digest_size=16)
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_cache(file_name):
+    '''Return numbers, spin, grid, titles and memory-mapped cohp data from sidecar cache
+       file_name.npy and file_name.json if they belong to file_name, otherwise None'''
+    try:
+        with open(file_name + ".json") as f:
+            header = json.load(f)
+        stat = os.stat(file_name)
+        if header["version"] != cache_version or header["size"] != stat.st_size:
+            return None
+        if header["mtime"] != stat.st_mtime_ns:  # touched or copied file: compare content
+            if header["hash"] != file_hash(file_name):
+                return None
+            header["mtime"] = stat.st_mtime_ns
+            write_cache_header(file_name, header)
+        cohp = np.load(file_name + ".npy", mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    if cohp.shape != (1 + 2 * header["num"] * header["spin"], header["grid"]):
+        return None
+    return header["num"],header["spin"],header["grid"],header["titles"],cohp
+
+
+def write_cache_header(file_name, header):
+    '''Write header of sidecar cache file_name.json atomically'''
+    tmp = "%s.%d.tmp" % (file_name + ".json", os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp, file_name + ".json")
+
+
+def write_cache(file_name, num, spin, grid, titles, cohp):
+    '''Write cohp data into sidecar cache file_name.npy (one contiguous row for each column of
+       COHPCAR.lobster) and file_name.json keyed by size, mtime and content hash of file_name'''
+    stat = os.stat(file_name)
+    header = {"version": cache_version, "size": stat.st_size, "mtime": stat.st_mtime_ns,
+              "hash": file_hash(file_name), "num": num, "spin": spin, "grid": grid, "titles": titles}
+    try:
+        tmp = "%s.%d.tmp.npy" % (file_name, os.getpid())
+        np.save(tmp, np.ascontiguousarray(cohp))
+        os.replace(tmp, file_name + ".npy")
+        write_cache_header(file_name, header)
+    except OSError:  # such as read-only directory
+        print("Cache of %s is not written." % file_name)
+
+
+def process_file(file_name, cache=True, verbose=True):
+    '''Loading COHPCAR.lobster file and return numbers, titles and cohp data of interactions.
+       The data is memory-mapped from sidecar cache file_name.npy if cache is True. The cache is
+       written for plain files only, also for compressed files if cache is "all"'''
+    #file_name="COHPCAR.lobster"
+    cached = load_cache(file_name) if cache else None
+    if cached is not None:
+        if verbose:
+            print("Reading cache of COHPCAR.lobster...")
+        num,spin,grid,titles,cohp = cached
+    else:
+        if verbose:
+            print("Reading COHPCAR.lobster...")
+        with open_cohpcar(file_name) as f:  # plain or compressed file
+            num,spin,grid,titles = read_header(f)
+            cohp = read_data(f, grid, 1 + 2 * num * spin).T  # rows: energy, cohp and icohp of each interaction
+        if cache == "all" or (cache and not compression(file_name)):  # no uncompressed copy of archive
+            write_cache(file_name, num, spin, grid, titles, cohp)
+    if verbose:
+        print(len(cohp))
+        print("Including cohp of "+str(num))
+        print(titles)
+        # energy = cohp[0]
+        print("COHP data is loaded.")
+    return num,titles,cohp
+
+
+def row_offsets(f, grid, chunk=1<<24):
+    '''Return byte offsets of grid data lines (and end of last line) of COHPCAR.lobster from
+       current position of file object f, by scanning newlines without parsing numbers'''
+    offsets = np.empty(grid + 1, dtype=np.int64)
+    pos = offsets[0] = f.tell()
+    n = 1
+    while n <= grid:
+        block = f.read(chunk)
+        if not block:
+            break
+        newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)[:grid + 1 - n] + pos + 1
+        offsets[n:n+len(newlines)] = newlines
+        n += len(newlines)
+        pos += len(block)
+    if n == grid:  # last line without newline
+        offsets[n] = pos
+    elif n < grid:
+        raise ValueError("COHP data is incomplete: %d of %d lines are found." % (n - 1, grid))
+    return offsets
+
+
+class LazyCohp:
+    '''Lazy cohp matrix (column, grid) of COHPCAR.lobster restricted to energy window (Emin, Emax).
+       It is indexed like cohp of process_file (cohp[0], cohp[columns], cohp[columns, points]) and
+       only the requested columns of the window are read from memory-mapped sidecar cache, which is
+       built on first use if cache is True. Without cache, lines of the window are read from
+       COHPCAR.lobster located by row offsets'''
+
+    def __init__(self, file_name, window=None, cache=True, chunk=1<<22):
+        cached = load_cache(file_name) if cache else None
+        if cached is None and compression(file_name) and cache != "all":
+            raise io.UnsupportedOperation("%s is compressed: no random access without sidecar cache." % file_name)
+        if cached is None and cache:  # first use: parse once, later runs read only the query
+            process_file(file_name, cache, verbose=False)
+            cached = load_cache(file_name)
+        if cached is not None:
+            self.num,self.spin,self.grid,self.titles,self.matrix = cached
+        else:
+            if compression(file_name):
+                raise io.UnsupportedOperation("%s is compressed: no random access without sidecar cache." % file_name)
+            self.matrix = None
+            with open(file_name, 'rb') as f:
+                self.num,self.spin,self.grid,self.titles = read_header(f)
+                self.offsets = row_offsets(f, self.grid)
+        self.file_name = file_name
+        self.chunk = chunk
+        self.ncol = 1 + 2 * self.num * self.spin
+        self.loaded = {}  # column: data in window
+        self.first, self.last = self.read_lines([0, self.grid - 1], [0])[0]  # energy range
+        self.start, self.stop = 0, self.grid
+        if window is not None:
+            if window[0] > window[1] or window[1] < self.first or window[0] > self.last:
+                raise ValueError("Energy window %g:%g is out of energy range %g:%g of %s." % (window[0], window[1], self.first, self.last, file_name))
+            self.start = int(self.search([window[0]])[0])
+            self.stop = int(self.search([window[1]], "right")[0])
+            self.start, self.stop = max(self.start - 1, 0), min(self.stop + 1, self.grid)  # enclose window
+
+    def search(self, energies, side="left"):
+        '''Return indices of lines where energies would be inserted in energy order like np.searchsorted,
+           from memory-mapped energies or by bisection over lines of the file with one file handle'''
+        if self.matrix is not None:
+            return np.searchsorted(self.matrix[0], energies, side)
+        indices = []
+        with open(self.file_name, 'rb') as f:
+            for energy in energies:
+                lo, hi = 0, self.grid
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    f.seek(self.offsets[mid])
+                    value = float(f.readline().split()[0])
+                    if value < energy or (side == "right" and value == energy):
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                indices.append(lo)
+        return np.array(indices, dtype=int)
+
+    def __len__(self):
+        return self.ncol
+
+    def load(self, columns):
+        '''Return data (column, window) of columns, reading columns which are not loaded'''
+        missing = [c for c in dict.fromkeys(columns) if c not in self.loaded]
+        if missing and self.matrix is not None:
+            for c, data in zip(missing, self.matrix[missing, self.start:self.stop]):
+                self.loaded[c] = data
+        elif missing:
+            data = np.empty((len(missing), self.stop - self.start))
+            with open(self.file_name, 'rb') as f:
+                i = self.start
+                while i < self.stop:  # lines of about chunk bytes
+                    j = min(max(int(np.searchsorted(self.offsets, self.offsets[i] + self.chunk)), i + 1), self.stop)
+                    f.seek(self.offsets[i])
+                    block = np.fromstring(f.read(self.offsets[j] - self.offsets[i]).decode(), sep=" ")
+                    data[:, i-self.start:j-self.start] = block.reshape(j - i, self.ncol)[:, missing].T
+                    i = j
+            for c, row in zip(missing, data):
+                self.loaded[c] = row
+        return np.array([self.loaded[c] for c in columns]).reshape(len(columns), self.stop - self.start)
+
+    def read_lines(self, lines, columns):
+        '''Return data (column, line) of columns of given lines of the whole file, in or out of window'''
+        if self.matrix is not None:
+            return np.asarray(self.matrix[np.ix_(columns, lines)])
+        data = np.empty((len(columns), len(lines)))
+        with open(self.file_name, 'rb') as f:
+            for k, i in enumerate(lines):
+                f.seek(self.offsets[i])
+                data[:, k] = np.array(f.readline().split(), dtype=float)[columns]
+        return data
+
+    def at(self, columns, energies):
+        '''Return values (column, energy) of columns linearly interpolated at energies, read from the
+           two lines around each energy found by bisection over the whole file'''
+        upper = np.clip(self.search(energies), 1, self.grid - 1)
+        data = self.read_lines(np.union1d(upper - 1, upper).tolist(), [0] + list(columns))
+        lo, hi, t = interp_weights(data[0], energies)
+        return data[1:, lo] * (1 - t) + data[1:, hi] * t
+
+    def __getitem__(self, key):
+        if type(key) is tuple:
+            rows = np.asarray(key[0])
+            unique, inverse = np.unique(rows, return_inverse=True)
+            return self.load(unique.tolist())[(inverse.reshape(rows.shape),) + key[1:]]
+        rows = np.asarray(key)
+        return self.load(rows.ravel().tolist()).reshape(rows.shape + (self.stop - self.start,))
+
+
+def load_cohp(file_name, cache=True, window=None, verbose=True):
+    '''Return numbers, titles and cohp data of process_file, or LazyCohp of energy window if window is
+       given and the file can be read lazily'''
+    if window is not None:
         try:
-            index0
-        except NameError:
-            print("Your input orbitals are not in COHPCAR.lobster!")
-            return None,None,None,None
-        else: 
-            cohp_alpha = -cohp[index0*2+1]
-            icohp_alpha = cohp[index0*2+2][int(np.argwhere(cohp[0]==0))]
-            if len(cohp) == num * 4 + 1: # spin polarization
-                cohp_beta = -cohp[num*2+index0*2+1]
-                icohp_beta = cohp[num*2+index0*2+2][int(np.argwhere(cohp[0]==0))]  # icohp value at E-Ef=0eV
-            else:  # spin unpolarization
-                cohp_beta = np.zeros(len(cohp[0]))
-                icohp_beta = 0
-    elif type(orbital[0]) is list and type(orbital[1]) is not list:
-        cohp_alpha = np.zeros(len(cohp[0]))
-        cohp_beta = np.zeros(len(cohp[0]))
-        icohp_alpha = 0
-        icohp_beta = 0
-        for j in range(len(orbital[0])):
-            for i in range(num):
-                if orbital[0][j] in titles[i][0] and orbital[1] in titles[i][1]:
-                    index0 = i
-            try:
-                index0
-            except NameError:
-                print("Your input orbitals are not in COHPCAR.lobster!")
-                return None,None,None,None
-            else: 
-                cohp_alpha_one = -cohp[index0*2+1]
-                icohp_alpha_one = cohp[index0*2+2][int(np.argwhere(cohp[0]==0))]            
-                cohp_alpha = cohp_alpha + cohp_alpha_one            
-                icohp_alpha = icohp_alpha + icohp_alpha_one
-                if len(cohp) == num * 4 + 1: # spin polarization
-                    cohp_beta_one = -cohp[num*2+index0*2+1]
-                    icohp_beta_one = cohp[num*2+index0*2+2][int(np.argwhere(cohp[0]==0))]
-                    cohp_beta = cohp_beta + cohp_beta_one
-                    icohp_beta = icohp_beta + icohp_beta_one
-                else:  # spin unpolarization
-                    cohp_beta = np.zeros(len(cohp[0]))
-                    icohp_beta = 0
-    elif type(orbital[0]) is not list and type(orbital[1]) is list:
-        cohp_alpha = np.zeros(len(cohp[0]))
-        cohp_beta = np.zeros(len(cohp[0]))
-        icohp_alpha = 0
-        icohp_beta = 0
-        for j in range(len(orbital[1])):
-            for i in range(num):
-                if orbital[0] in titles[i][0] and orbital[1][j] in titles[i][1]:
-                    index0 = i
-            try:
-                index0
-            except NameError:
-                print("Your input orbitals are not in COHPCAR.lobster!")
-                return None,None,None,None
-            else: 
-                cohp_alpha_one = -cohp[index0*2+1]
-                icohp_alpha_one = cohp[index0*2+2][int(np.argwhere(cohp[0]==0))]            
-                cohp_alpha = cohp_alpha + cohp_alpha_one            
-                icohp_alpha = icohp_alpha + icohp_alpha_one
-                
-                if len(cohp) == num * 4 + 1: # spin polarization
-                    cohp_beta_one = -cohp[num*2+index0*2+1]
-                    icohp_beta_one = cohp[num*2+index0*2+2][int(np.argwhere(cohp[0]==0))]
-                    cohp_beta = cohp_beta + cohp_beta_one
-                    icohp_beta = icohp_beta + icohp_beta_one
-                else:  # spin unpolarization
-                    cohp_beta = np.zeros(len(cohp[0]))
-                    icohp_beta = 0
+            cohp = LazyCohp(file_name, window, cache)
+            return cohp.num,cohp.titles,cohp
+        except io.UnsupportedOperation as e:  # compressed file without cache
+            if verbose:
+                print("%s Whole file is read." % e)
+    return process_file(file_name, cache, verbose)
+
+
+def build_index(titles):
+    '''Return dict mapping (orbital of atom 1, orbital of atom 2) to indices of interactions in titles.
+       Orbital may be an orbital name such as 3d_xy, a shell such as 3d (all its orbitals) or all.
+       Column of cohp is index*2+1 for alpha (index*2+1+num*2 for beta) and icohp is the next one.
+       Orbital names do not tell atom pairs apart, so only files of one atom pair are indexed'''
+    pairs = [title for title in titles[1:] if type(title) is not list]
+    if len(pairs) > 1:
+        raise ValueError("%d atom pairs (%s, ...) are in COHPCAR.lobster: orbital selections need one atom pair, "
+                         "use -b for ICOHP of all atom pairs." % (len(pairs), ", ".join(pairs[:2])))
+    index = {("all", "all"): [1]}  # total interaction of the atom pair
+    for i, title in enumerate(titles[2:], 2):
+        if type(title) is not list:  # interaction of atom pair
+            continue
+        orb1, orb2 = title
+        for key1 in {orb1, orb1.split("_")[0], "all"}:
+            for key2 in {orb2, orb2.split("_")[0], "all"}:
+                if (key1, key2) != ("all", "all"):
+                    index.setdefault((key1, key2), []).append(i)
+    return index
+
+
+def find_interactions(index, orbital):
+    '''Return indices of interactions of orbital pairs [orbital(s) of atom 1, orbital(s) of atom 2]
+       from index of build_index, or None if any of the pairs is not in COHPCAR.lobster'''
+    orbs1 = orbital[0] if type(orbital[0]) is list else [orbital[0]]
+    orbs2 = orbital[1] if type(orbital[1]) is list else [orbital[1]]
+    pairs = [(orb1, orb2) for orb1 in orbs1 for orb2 in orbs2]
+    missing = [pair for pair in pairs if pair not in index]
+    if missing:
+        print("Your input orbitals are not in COHPCAR.lobster: %s!" % ", ".join("-".join(pair) for pair in missing))
+        return None
+    return [i for pair in pairs for i in index[pair]]
+
+
+def selection_weights(index, orbitals):
+    '''Return used interactions and weights (selection, used interaction) of list of orbital pairs,
+       or None,None if any of the pairs is not in COHPCAR.lobster'''
+    selections = [find_interactions(index, orbital) for orbital in orbitals]
+    if not selections or any(selection is None for selection in selections):
+        return None,None
+    used, inverse = np.unique(np.concatenate(selections), return_inverse=True)
+    weight = np.zeros((len(selections), len(used)))  # number of times of each used interaction in selection
+    rows = np.repeat(np.arange(len(selections)), [len(selection) for selection in selections])
+    np.add.at(weight, (rows, inverse), 1)
+    return used,weight
+
+
+def interp_weights(x, xnew):
+    '''Return lower and upper indices and weight of upper point of linear interpolation on
+       increasing grid x at xnew, which is clamped to range of x'''
+    xnew = np.clip(np.asarray(xnew, dtype=float), x[0], x[-1])
+    hi = np.clip(np.searchsorted(x, xnew), 1, len(x) - 1)
+    lo = hi - 1
+    return lo, hi, (xnew - x[lo]) / (x[hi] - x[lo])
+
+
+def values_at(cohp, columns, energies):
+    '''Return values (column, energy) of columns of cohp linearly interpolated at energies. Lines around
+       energies out of the window of LazyCohp are read from its file. ValueError is raised for energies
+       out of energy range of cohp data'''
+    energies = np.atleast_1d(np.asarray(energies, dtype=float))
+    if isinstance(cohp, LazyCohp):
+        first, last = cohp.first, cohp.last
     else:
-        cohp_alpha = np.zeros(len(cohp[0]))
-        cohp_beta = np.zeros(len(cohp[0]))
-        icohp_alpha = 0
-        icohp_beta = 0
-        for j in range(len(orbital[0])):
-            for k in range(len(orbital[1])):
-                for i in range(num):
-                    if orbital[0][j] in titles[i][0] and orbital[1][k] in titles[i][1]:
-                        index0 = i
-                try:
-                    index0
-                except NameError:
-                    print("Your input orbitals are not in COHPCAR.lobster!")
-                    return None,None,None,None
-                else: 
-                    cohp_alpha_one = -cohp[index0*2+1]
-                    icohp_alpha_one = cohp[index0*2+2][int(np.argwhere(cohp[0]==0))]                
-                    cohp_alpha = cohp_alpha + cohp_alpha_one                
-                    icohp_alpha = icohp_alpha + icohp_alpha_one
-                    
-                    if len(cohp) == num * 4 + 1: # spin polarization
-                        cohp_beta_one = -cohp[num*2+index0*2+1]
-                        icohp_beta_one = cohp[num*2+index0*2+2][int(np.argwhere(cohp[0]==0))]
-                        cohp_beta = cohp_beta + cohp_beta_one
-                        icohp_beta = icohp_beta + icohp_beta_one
-                    else:  # spin unpolarization
-                        cohp_beta = np.zeros(len(cohp[0]))
-                        icohp_beta = 0
-    return cohp_alpha,cohp_beta,icohp_alpha,icohp_beta
-
-
-def get_orb():
-    '''get orbital paris from user input and return corresponding orbital pairs in format of COHPCAR.lobster'''
-    print("=="*30)
+        first, last = cohp[0][0], cohp[0][-1]
+    outside = energies[(energies < first) | (energies > last)]
+    if len(outside):
+        raise ValueError("Energies %s are out of energy range %g:%g." % (",".join("%g" % e for e in outside), first, last))
+    if isinstance(cohp, LazyCohp):
+        return cohp.at(columns, energies)
+    lo, hi, t = interp_weights(cohp[0], energies)
+    columns = np.asarray(columns)[:, None]
+    return cohp[columns, lo] * (1 - t) + cohp[columns, hi] * t
+
+
+def cumulative_integral(energy, curves):
+    '''Return cumulative trapezoid integral of curves (..., grid) over energy from bottom of grid'''
+    integral = np.zeros(curves.shape)
+    np.cumsum((curves[..., 1:] + curves[..., :-1]) * (np.diff(energy) / 2), axis=-1, out=integral[..., 1:])
+    return integral
+
+
+def get_cohps(num,titles,cohp,orbitals,index=None):
+    '''Return cohp curves (selection, spin, grid) and icohp values (selection, spin) of list of orbital
+       pairs by one gather of used columns and one matrix product with weights of selections'''
+    if index is None:
+        index = build_index(titles)
+    used, weight = selection_weights(index, orbitals)
+    if used is None:
+        return None,None
+    nspin = 2 if len(cohp) == num * 4 + 1 else 1  # spin polarization or not
+    if isinstance(cohp, LazyCohp):  # read all used columns in one pass
+        cohp.load([0] + [num*2*spin + i*2 + 1 for spin in range(nspin) for i in used])
+    at_fermi = values_at(cohp, [num*2*spin + i*2 + 2 for spin in range(nspin) for i in used], 0.0)  # icohp at E-Ef=0eV
+    curves = np.empty((len(weight), nspin, len(cohp[0])))
+    icohps = np.empty((len(weight), nspin))
+    for spin in range(nspin):
+        columns = num*2*spin + used*2 + 1
+        np.matmul(-weight, cohp[columns], out=curves[:, spin])  # -COHP
+        icohps[:, spin] = weight @ at_fermi[spin*len(used):(spin+1)*len(used), 0]
+    return curves,icohps
+
+
+def get_icohps(num,titles,cohp,orbitals,windows,index=None,integrate=False):
+    '''Return icohp values (selection, spin, window) of list of orbital pairs for each of windows:
+       energy E (icohp up to E) or (Emin, Emax), interpolated on cumulative icohp of used interactions.
+       The icohp columns of COHPCAR.lobster are used (lines around the limits only, also out of window
+       of LazyCohp), or the cohp columns of loaded energy range are integrated once if integrate is True'''
+    if index is None:
+        index = build_index(titles)
+    used, weight = selection_weights(index, orbitals)
+    if used is None:
+        return None
+    windows = [(None, w) if np.ndim(w) == 0 else tuple(w) for w in windows]
+    nspin = 2 if len(cohp) == num * 4 + 1 else 1  # spin polarization or not
+    lower = [i for i, w in enumerate(windows) if w[0] is not None]  # windows with lower limit
+    limits = [w[1] for w in windows] + [windows[i][0] for i in lower]
+    if integrate and isinstance(cohp, LazyCohp):
+        if cohp.start > 0 and len(lower) < len(windows):
+            raise ValueError("ICOHP up to an energy can not be integrated from the bottom of energy window, use Emin:Emax.")
+        cohp.load([0] + [num*2*spin + i*2 + 1 for spin in range(nspin) for i in used])  # one pass
+    elif not integrate:  # only the lines around limits of windows are read
+        at_limits = values_at(cohp, [num*2*spin + i*2 + 2 for spin in range(nspin) for i in used], limits)
+    icohps = np.empty((len(weight), nspin, len(windows)))
+    for spin in range(nspin):
+        columns = num*2*spin + used*2 + 1
+        if integrate:  # limits have to be in loaded energy range
+            cumulative = np.vstack((cohp[0], cumulative_integral(cohp[0], cohp[columns])))
+            values = values_at(cumulative, np.arange(1, len(used) + 1), limits)
+        else:
+            values = at_limits[spin*len(used):(spin+1)*len(used)]
+        values[:, lower] -= values[:, len(windows):]
+        icohps[:, spin] = weight @ values[:, :len(windows)]
+    return icohps
+
+
+def parse_orb(inp, orbA, orbB):
+    '''Return status, orbital pairs in format of COHPCAR.lobster and input orbital names of each pair
+       from selection string such as "all all;3d 3d;4s 4s", orbA and orbB: all orbitals of atom 1 and 2'''
     orb1=["all","1s","2s","3s","4s","5s","6s","7s",\
     "2px","2py","2pz","3px","3py","3pz","4px","4py","4pz","5px","5py","5pz","6px","6py","6pz","7px","7py","7pz",\
     "3dxy","3dyz","3dxz","3dz2","3dx2-y2","4dxy","4dyz","4dxz","4dz2","4dx2-y2",\
@@ -175,7 +503,7 @@ def get_orb():
     orb_d2=["_xy","_yz","_xz","_z^2","_x^2-y^2"]
     orb_f2=["_y(3x^2-y^2)","_xyz","_yz^2","_z^3","_xz^2","_z(x^2-y^2)","_x(x^2-3y^2)"]
     # input orbital paris: such as "sum sum;4s 4s"
-    inp = input("Please select interactions: \n all\n s px py pz\n dxy dyz dxz dz2 dx2-y2\n fy3x2 fxyz fyz2 fz3 fxz2 fzx2 fx3\n such as: 3dyz 2py \n such as: 3d 3d \n such as: all all;3d 3d;4s 4s \n").split(";")
+    inp = [i for i in inp.split(";") if i.strip()] or [""]
     if inp[0] == "":
         status = 0
         print("End input!")
@@ -229,63 +557,552 @@ def get_orb():
                     else:
                         orb_pairs.append(orb2[orb1.index(sss)])  # 2px --> 2p_x
             orbitals.append(orb_pairs)
-        print(orbitals)
         return status,orbitals,inp2  # status,orbital name list in COHPCAR.losber,input orbital name list for each orbital pairs
 
-    
-alpha,beta=chr(945),chr(946)
-num,titles,cohp = process_file("COHPCAR.lobster")
-
-orbA = list(set([i[0] for i in titles[2:]]))  # all orbitals in atom 1
-orbB = list(set([i[1] for i in titles[2:]]))  # all orbitals in atom 2
-
-status1 = 1
-while status1 == 1:
-    status1,orb_cohp,orb_inp=get_orb()
-    if status1 ==1:
-        cohps=[]
-        icohps=[]
-        orbs=[]
-        status2 = 1
-        for i in range(len(orb_inp)):
-            cohp_a,cohp_b,icohp_a,icohp_b=get_cohp(num,titles,cohp,orb_cohp[i])
-            if cohp_a is None:
-                status2 = 0
-                break
-            else:
-                if len(cohp) == num * 4 + 1: # spin polarization
-                    print("The ICOHP values of %s are \n   alpha \t beta\n %f\t%f" %("-".join(orb_inp[i]),icohp_a,icohp_b))
-                    cohps.append(cohp_a)
-                    cohps.append(cohp_b)
-                    icohps.append(icohp_a)
-                    icohps.append(icohp_b)
-                    orbs.append("_".join(orb_inp[i])+"_"+alpha)
-                    orbs.append("_".join(orb_inp[i])+"_"+beta)
-                else:  # spin unpolarization
-                    cohps.append(cohp_a)
-                    icohps.append(icohp_a)
-                    orbs.append("_".join(orb_inp[i]))
-                    print("The ICOHP values of %s is %f.\n" %("-".join(orb_inp[i]),icohp_a))
-        if status2 == 1:    
-            df = pd.DataFrame(np.array(cohps).T,index = cohp[0].T,columns=orbs)
-            df.plot()
-            plt.xlim(-8,5)
-            plt.xlabel(r"$E-E_f\ (eV)$",fontsize=12)
-            plt.ylabel("-COHP",fontsize=12)
-            plt.tight_layout()
-            plt.show()
-            check=input("Do you want to save the cohp data: y or [n]\n")
-            if check=="y":
-                cohp_set = np.vstack((cohp[0],np.array(cohps))).T
-                header="{:^12s}".format("E-Ef(eV)") + " ".join(map(lambda x: "{:^12s}".format(x),orbs)) + "\n" \
-                + "{:^12s}".format("ICOHP") + " ".join(map(lambda x: "{:^12.5f}".format(x),icohps))
-                output="cohp_"+'_'.join('-'.join(inner) for inner in orb_inp)+".dat"
-                np.savetxt(output,cohp_set,fmt="%12.5f",header=header)
-                print("Selected COHP data has been written into %s file." %output)
-            else:
-                pass
+
+def get_orb(orbA, orbB):
+    '''get orbital paris from user input and return corresponding orbital pairs in format of COHPCAR.lobster'''
+    print("=="*30)
+    inp = input("Please select interactions: \n all\n s px py pz\n dxy dyz dxz dz2 dx2-y2\n fy3x2 fxyz fyz2 fz3 fxz2 fzx2 fx3\n such as: 3dyz 2py \n such as: 3d 3d \n such as: all all;3d 3d;4s 4s \n")
+    status,orbitals,inp2 = parse_orb(inp, orbA, orbB)
+    if status == 1:
+        print(orbitals)
+    return status,orbitals,inp2
+
+
+def cohp_labels(orb_inp, nspin):
+    '''Return column names of cohp data of input orbital pairs for nspin spin channels'''
+    if nspin == 2: # spin polarization
+        return ["_".join(orbs)+"_"+spin for orbs in orb_inp for spin in (chr(945),chr(946))]
+    return ["_".join(orbs) for orbs in orb_inp]  # spin unpolarization
+
+
+def print_icohp(orb_inp, icohps):
+    '''Print icohp values (selection, spin) of input orbital pairs'''
+    for i in range(len(orb_inp)):
+        if icohps.shape[1] == 2: # spin polarization
+            print("The ICOHP values of %s are \n   alpha \t beta\n %f\t%f" %("-".join(orb_inp[i]),icohps[i,0],icohps[i,1]))
+        else:  # spin unpolarization
+            print("The ICOHP values of %s is %f.\n" %("-".join(orb_inp[i]),icohps[i,0]))
+
+
+def write_cohp(output, energy, cohps, orbs, icohps):
+    '''Write energy, cohp curves (one row for each column orbs) and icohp values into file output'''
+    cohp_set = np.vstack((energy,cohps)).T
+    header="{:^12s}".format("E-Ef(eV)") + " ".join(map(lambda x: "{:^12s}".format(x),orbs)) + "\n" \
+    + "{:^12s}".format("ICOHP") + " ".join(map(lambda x: "{:^12.5f}".format(x),icohps))
+    np.savetxt(output,cohp_set,fmt="%12.5f",header=header)
+    print("Selected COHP data has been written into %s file." %output)
+
+
+def write_icohp(output, orb_inp, icohps):
+    '''Write table of icohp values (selection, spin) of input orbital pairs into file output'''
+    with open(output, 'w') as f:
+        if icohps.shape[1] == 2: # spin polarization
+            f.write("{:<24s}{:>12s}{:>12s}{:>12s}\n".format("# Interaction","alpha","beta","total"))
+            for orbs, (a, b) in zip(orb_inp, icohps):
+                f.write("{:<24s}{:>12.5f}{:>12.5f}{:>12.5f}\n".format("-".join(orbs),a,b,a+b))
+        else:  # spin unpolarization
+            f.write("{:<24s}{:>12s}\n".format("# Interaction","ICOHP"))
+            for orbs, (a,) in zip(orb_inp, icohps):
+                f.write("{:<24s}{:>12.5f}\n".format("-".join(orbs),a))
+    print("ICOHP table has been written into %s file." %output)
+
+
+def parse_windows(text):
+    '''Return list of energies and (Emin, Emax) windows from string such as "0,-1,-8:0,-8:-4"'''
+    return [tuple(map(float, w.split(":"))) if ":" in w else float(w) for w in text.split(",") if w.strip()]
+
+
+def write_windows(output, orb_inp, windows, icohps):
+    '''Write table of icohp values (selection, spin, window) of input orbital pairs into file output'''
+    names = ["%g:%g" % w if type(w) is tuple else "%g" % w for w in windows]
+    spins = [" "+chr(945), " "+chr(946)] if icohps.shape[1] == 2 else [""]
+    with open(output, 'w') as f:
+        f.write("{:<24s}".format("# Interaction") + "".join("{:>12s}".format(name) for name in names) + "\n")
+        for orbs, values in zip(orb_inp, icohps):
+            for spin, value in zip(spins, values):
+                f.write("{:<24s}".format("-".join(orbs)+spin) + "".join("{:>12.5f}".format(x) for x in value) + "\n")
+    print("ICOHP of energy windows has been written into %s file." %output)
+
+
+class CohpPlotter:
+    '''Render cohp curves into image files on Agg canvas without pyplot, reusing one figure, axes
+       and lines whose data are updated for each plot'''
+
+    def __init__(self, xlim=(-8,5), figsize=(6.4,4.8), dpi=150):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        self.figure = Figure(figsize=figsize, dpi=dpi, constrained_layout=True)  # layout follows tick labels
+        FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot()
+        self.axes.set_xlim(*xlim)
+        self.axes.set_xlabel(r"$E-E_f\ (eV)$",fontsize=12)
+        self.axes.set_ylabel("-COHP",fontsize=12)
+        self.axes.axhline(0, color="gray", linewidth=0.5)
+        self.axes.axvline(0, color="gray", linewidth=0.5, linestyle="--")
+        self.lines = []
+
+    def plot(self, energy, cohps, labels, output, title=None):
+        '''Draw rows of cohps over energy with labels and save figure into output (.png, .pdf or .svg)'''
+        while len(self.lines) < len(cohps):
+            self.lines.append(self.axes.plot([], [])[0])
+        for line, y, label in zip(self.lines, cohps, labels):
+            line.set_data(energy, y)
+            line.set_label(label)
+            line.set_visible(True)
+        for line in self.lines[len(cohps):]:
+            line.set_visible(False)
+        xlim = self.axes.get_xlim()
+        shown = np.asarray(cohps)[:, (energy >= xlim[0]) & (energy <= xlim[1])]
+        if shown.size and np.isfinite(shown).any():
+            ymin, ymax = np.nanmin(shown), np.nanmax(shown)
+            margin = 0.05 * (ymax - ymin) or 1
+            self.axes.set_ylim(ymin - margin, ymax + margin)
+        self.axes.legend(handles=self.lines[:len(cohps)])
+        self.axes.set_title(title or "")
+        self.figure.savefig(output)
+        return output
+
+
+plotter = None  # plotter of worker process
+
+
+def init_plotter(xlim):
+    '''Create plotter of worker process'''
+    global plotter
+    plotter = CohpPlotter(xlim)
+
+
+def plot_job(job):
+    '''Render one job (energy, cohps, labels, output, title) by plotter of worker process'''
+    return plotter.plot(*job)
+
+
+def plot_jobs(jobs, workers=None, xlim=(-8,5)):
+    '''Render jobs (energy, cohps, labels, output, title) into image files in parallel worker processes'''
+    if workers == 1 or len(jobs) == 1:
+        init_plotter(xlim)
+        return [plot_job(job) for job in jobs]
+    with ProcessPoolExecutor(workers, initializer=init_plotter, initargs=(xlim,)) as pool:
+        return list(pool.map(plot_job, jobs, chunksize=max(1, len(jobs) // (4 * (workers or os.cpu_count() or 1)))))
+
+
+def interactive(num,titles,cohp,index,orbA,orbB,smoothing=None,energy_grid=None):
+    '''Plot selected cohp (resampled and broadened if smoothing is given) interactively and save it
+       if required, until empty input'''
+    from matplotlib import pyplot as plt
+    status1 = 1
+    while status1 == 1:
+        status1,orb_cohp,orb_inp=get_orb(orbA,orbB)
+        if status1 ==1:
+            curves,icohps=get_cohps(num,titles,cohp,orb_cohp,index)
+            if curves is not None:
+                print_icohp(orb_inp, icohps)
+                orbs = cohp_labels(orb_inp, curves.shape[1])
+                energy, curves = smooth(cohp[0], curves, smoothing, energy_grid)
+                cohps = curves.reshape(-1, len(energy))  # view: one row for each selection and spin
+                plt.plot(energy, cohps.T)
+                plt.legend(orbs)
+                plt.xlim(-8,5)
+                plt.xlabel(r"$E-E_f\ (eV)$",fontsize=12)
+                plt.ylabel("-COHP",fontsize=12)
+                plt.tight_layout()
+                plt.show()
+                check=input("Do you want to save the cohp data: y or [n]\n")
+                if check=="y":
+                    output="cohp_"+'_'.join('-'.join(inner) for inner in orb_inp)+".dat"
+                    write_cohp(output, energy, cohps, orbs, icohps.ravel())
+
+
+class CohpExplorer:
+    '''Persistent interactive view of selected cohp. Selections typed in text box (such as "3d 2p;4s 2s")
+       only update data of existing lines, which are redrawn with legend and icohp by blitting on
+       saved background, while cohp matrix and index stay in memory'''
+
+    def __init__(self,num,titles,cohp,index,orbA,orbB,smoothing=None,energy_grid=None,xlim=(-8,5),initial="all all"):
+        from matplotlib import pyplot as plt
+        from matplotlib.widgets import TextBox, Button
+        self.num,self.titles,self.cohp,self.index,self.orbA,self.orbB = num,titles,cohp,index,orbA,orbB
+        self.smoothing,self.energy_grid = smoothing,energy_grid
+        self.figure, self.axes = plt.subplots(figsize=(8,6))
+        self.figure.subplots_adjust(bottom=0.18)
+        self.axes.set_xlim(*xlim)
+        self.axes.set_xlabel(r"$E-E_f\ (eV)$",fontsize=12)
+        self.axes.set_ylabel("-COHP",fontsize=12)
+        self.axes.axhline(0, color="gray", linewidth=0.5)
+        self.axes.axvline(0, color="gray", linewidth=0.5, linestyle="--")
+        self.lines = []
+        self.legend = None
+        self.info = self.axes.text(0.02, 0.98, "", transform=self.axes.transAxes, va="top", fontsize=9, animated=True)
+        self.box = TextBox(self.figure.add_axes([0.15,0.04,0.62,0.06]), "Select ", initial=initial)
+        self.box.on_submit(self.update)
+        self.button = Button(self.figure.add_axes([0.8,0.04,0.1,0.06]), "Save")
+        self.button.on_clicked(self.save)
+        self.background = None
+        self.current = None
+        self.figure.canvas.mpl_connect("draw_event", self.on_draw)
+        self.update(initial)
+
+    def on_draw(self, event):
+        '''Save background without animated artists after full redraw, then draw them on it'''
+        self.background = self.figure.canvas.copy_from_bbox(self.axes.bbox)
+        self.draw_artists()
+
+    def draw_artists(self, start=None):
+        '''Draw lines, legend and icohp text, with time (ms) since start of update if it is given'''
+        for line in self.lines:
+            self.axes.draw_artist(line)
+        if self.legend is not None:
+            self.axes.draw_artist(self.legend)
+        if start is not None:  # latency including redraw of lines and legend
+            self.info.set_text(self.info.get_text() + "\n%.1f ms" % (1000 * (time.perf_counter() - start)))
+        self.axes.draw_artist(self.info)
+
+    def blit(self, start=None):
+        '''Redraw animated artists on saved background'''
+        canvas = self.figure.canvas
+        canvas.restore_region(self.background)
+        self.draw_artists(start)
+        canvas.blit(self.axes.bbox)
+
+    def update(self, text):
+        '''Evaluate selections of text and update data of lines'''
+        start = time.perf_counter()
+        try:
+            status,orb_cohp,orb_inp = parse_orb(text, self.orbA, self.orbB)
+        except (ValueError, IndexError):
+            status = -1
+        curves = None
+        if status == 1:
+            curves,icohps = get_cohps(self.num,self.titles,self.cohp,orb_cohp,self.index)
+        if curves is None:
+            self.info.set_text("Unknown selection or interactions not in COHPCAR.lobster: %s" % text)
+        else:
+            labels = cohp_labels(orb_inp, curves.shape[1])
+            energy, curves = smooth(self.cohp[0], curves, self.smoothing, self.energy_grid)
+            rows = curves.reshape(-1, len(energy))
+            shown_energy, shown_rows = self.visible(energy, rows)
+            while len(self.lines) < len(rows):
+                self.lines.append(self.axes.plot([], [], animated=True)[0])
+            for line, y, label in zip(self.lines, shown_rows, labels):
+                line.set_data(shown_energy, y)
+                line.set_label(label)
+                line.set_visible(True)
+            for line in self.lines[len(rows):]:
+                line.set_visible(False)
+            self.legend = self.axes.legend(handles=self.lines[:len(rows)], loc="upper right", fontsize=9)
+            self.legend.set_animated(True)
+            self.current = (energy, rows, labels, icohps, orb_inp)
+            ylim = self.rescale(energy, rows)
+            self.info.set_text("ICOHP: " + "  ".join("%s %.4f" % (label, value) for label, value in zip(labels, icohps.ravel())))
+            if ylim is not None and self.background is not None:  # axes changed: full redraw, which saves background
+                self.axes.set_ylim(*ylim)
+                self.figure.canvas.draw()
+            elif ylim is not None:
+                self.axes.set_ylim(*ylim)
+        if self.background is None:
+            self.figure.canvas.draw_idle()
         else:
-            pass
+            self.blit(start if curves is not None else None)
+
+    def visible(self, energy, rows):
+        '''Return energy and rows in x range, reduced to minimum and maximum in each pixel column
+           if there are much more points than pixels'''
+        xlim = self.axes.get_xlim()
+        lo = max(int(np.searchsorted(energy, xlim[0])) - 1, 0)
+        hi = min(int(np.searchsorted(energy, xlim[1], side="right")) + 1, len(energy))
+        energy, rows = energy[lo:hi], rows[:, lo:hi]
+        width = max(int(self.axes.bbox.width), 1)
+        if len(energy) <= 4 * width:
+            return energy, rows
+        starts = np.arange(0, len(energy), len(energy) // width)  # the last bin holds the remainder
+        ends = np.append(starts[1:], len(energy)) - 1
+        shown_energy = np.stack([energy[starts], energy[ends]], axis=1).ravel()
+        shown_rows = np.stack([np.fmin.reduceat(rows, starts, axis=1), np.fmax.reduceat(rows, starts, axis=1)], axis=2)
+        return shown_energy, shown_rows.reshape(len(rows), -1)
+
+    def rescale(self, energy, rows):
+        '''Return new y limits if rows in x range are out of current y limits or less than tenth of them,
+           otherwise None'''
+        xlim = self.axes.get_xlim()
+        shown = rows[:, (energy >= xlim[0]) & (energy <= xlim[1])]
+        if not shown.size or not np.isfinite(shown).any():
+            return None
+        ymin, ymax = np.nanmin(shown), np.nanmax(shown)
+        low, high = self.axes.get_ylim()
+        if self.background is not None and low <= ymin and ymax <= high and (ymax - ymin) > 0.1 * (high - low):
+            return None
+        margin = 0.1 * (ymax - ymin) or 1  # room for next selections without full redraw
+        return ymin - margin, ymax + margin
+
+    def save(self, event=None):
+        '''Save current cohp data like interactive mode'''
+        if self.current is not None:
+            energy, rows, labels, icohps, orb_inp = self.current
+            output="cohp_"+'_'.join('-'.join(inner) for inner in orb_inp)+".dat"
+            write_cohp(output, energy, rows, labels, icohps.ravel())
+            self.info.set_text("Saved into %s" % output)
+            self.blit()
+
+
+def headless(num,titles,cohp,index,orbA,orbB,queries,output,windows=None,integrate=False,formats=(),workers=None,
+             smoothing=None,energy_grid=None):
+    '''Evaluate all selections of queries at once and write output.dat and output-ICOHP.dat without prompt,
+       output-windows.dat of icohp in energy windows if windows are given and one figure for each of
+       queries in each of formats (png, pdf or svg). Curves are resampled and broadened by smoothing
+       (width, kind) if they are given'''
+    status,orb_cohp,orb_inp = parse_orb(";".join(queries), orbA, orbB)
+    if status == 0:
+        raise SystemExit("No interaction is selected!")
+    curves,icohps=get_cohps(num,titles,cohp,orb_cohp,index)
+    if curves is None:
+        raise SystemExit(1)
+    print_icohp(orb_inp, icohps)
+    orbs = cohp_labels(orb_inp, curves.shape[1])
+    energy, curves = smooth(cohp[0], curves, smoothing, energy_grid)
+    write_cohp(output+".dat", energy, curves.reshape(-1, len(energy)), orbs, icohps.ravel())
+    write_icohp(output+"-ICOHP.dat", orb_inp, icohps)
+    if windows:
+        write_windows(output+"-windows.dat", orb_inp, windows, get_icohps(num,titles,cohp,orb_cohp,windows,index,integrate))
+    if formats:
+        nspin = curves.shape[1]
+        jobs = []
+        start = 0
+        for query in queries:  # one figure for each query
+            count = len([q for q in query.split(";") if q.strip()])
+            name = output+"_"+'_'.join('-'.join(inner) for inner in orb_inp[start:start+count])
+            for fmt in formats:
+                jobs.append((energy, curves[start:start+count].reshape(-1, len(energy)),
+                             orbs[start*nspin:(start+count)*nspin], name+"."+fmt, None))
+            start += count
+        for name in plot_jobs(jobs, workers):
+            print("Figure has been written into %s file." % name)
+
+
+label_re = re.compile(r"No\.\d+:([A-Za-z]+\d+)(?:\[(.+?)\])?->([A-Za-z]+\d+)(?:\[(.+?)\])?\(([-+.\deE]+)\)")
+
+
+def read_labels(file_name):
+    '''Return atom 1, atom 2, distance and orbital-resolved or not of each interaction (None for Average)
+       from titles of COHPCAR.lobster, such as No.2:Fe1[3d_xy]->O2[2p_x](1.98)'''
+    with open_cohpcar(file_name) as f:
+        f.readline()
+        num = int(f.readline().split()[0])
+        lines = [f.readline().decode() for i in range(num)]
+    labels = [None]
+    for line in lines[1:]:
+        match = label_re.search(line)
+        if match is None:
+            raise ValueError("Unknown interaction in %s: %s" % (file_name, line.strip()))
+        atom1, orb1, atom2, orb2, distance = match.groups()
+        labels.append((atom1, atom2, float(distance), orb1 is not None))
+    return labels
+
+
+def element(atom):
+    '''Return element of atom label, such as Fe of Fe12'''
+    return atom.rstrip("0123456789")
+
+
+def bond_matrix(num, cohp, labels, energy=0.0):
+    '''Return icohp up to energy of all atom-pair interactions (not orbital-resolved) reduced to
+       sparse atom x atom matrix: atoms, row, col, data (spin, nonzero), and to element pairs:
+       pairs, number of bonds and data (spin, pair)'''
+    bonds = np.array([i for i in range(1, num) if not labels[i][3]], dtype=int)
+    if len(bonds) == 0:
+        raise ValueError("No atom-pair interactions (without orbitals) are in COHPCAR.lobster for bond matrix.")
+    atoms = sorted(set(labels[i][j] for i in bonds for j in (0, 1)), key=lambda atom: int(atom[len(element(atom)):]))
+    code = {atom: k for k, atom in enumerate(atoms)}
+    atom1 = np.array([code[labels[i][0]] for i in bonds])
+    atom2 = np.array([code[labels[i][1]] for i in bonds])
+    nspin = 2 if len(cohp) == num * 4 + 1 else 1  # spin polarization or not
+    icohps = values_at(cohp, np.concatenate([num*2*spin + bonds*2 + 2 for spin in range(nspin)]), energy).reshape(nspin, len(bonds))
+    # atom x atom in both directions, bonds between the same atoms (such as periodic images) are summed
+    both = atom1 != atom2
+    keys = np.concatenate([atom1 * len(atoms) + atom2, (atom2 * len(atoms) + atom1)[both]])
+    keys, inverse = np.unique(keys, return_inverse=True)
+    data = np.zeros((nspin, len(keys)))
+    for spin in range(nspin):
+        np.add.at(data[spin], inverse, np.concatenate([icohps[spin], icohps[spin][both]]))
+    row, col = keys // len(atoms), keys % len(atoms)
+    # element pairs
+    elements = [tuple(sorted((element(labels[i][0]), element(labels[i][1])))) for i in bonds]
+    pairs, group = np.unique(["-".join(pair) for pair in elements], return_inverse=True)
+    count = np.bincount(group, minlength=len(pairs))
+    sums = np.array([np.bincount(group, icohps[spin], minlength=len(pairs)) for spin in range(nspin)])
+    return atoms,row,col,data,pairs,count,sums
+
+
+def write_bonds(output, atoms, row, col, data, pairs, count, sums):
+    '''Write sparse atom x atom icohp matrix into output-bonds.npz (COO: row, col, data of each spin,
+       shape and atoms), edge list into output-edges.dat and element pairs into output-elements.dat'''
+    np.savez(output+"-bonds.npz", atoms=np.array(atoms), row=row, col=col, data=data, shape=(len(atoms), len(atoms)))
+    spins = [chr(945), chr(946)] if len(data) == 2 else ["ICOHP"]
+    upper = row <= col  # each edge once
+    with open(output+"-edges.dat", 'w') as f:
+        f.write("{:<10s}{:<10s}".format("# Atom1", "Atom2") + "".join("{:>12s}".format(s) for s in spins) + "\n")
+        for a, b, values in zip(row[upper], col[upper], data[:, upper].T):
+            f.write("{:<10s}{:<10s}".format(atoms[a], atoms[b]) + "".join("{:>12.5f}".format(x) for x in values) + "\n")
+    with open(output+"-elements.dat", 'w') as f:
+        f.write("{:<12s}{:>8s}".format("# Pair", "Bonds") + "".join("{:>12s}{:>12s}".format(s, "mean") for s in spins) + "\n")
+        for k, pair in enumerate(pairs):
+            f.write("{:<12s}{:>8d}".format(pair, count[k]) + "".join("{:>12.5f}{:>12.5f}".format(x[k], x[k] / count[k]) for x in sums) + "\n")
+    print("Bond matrix has been written into %s-bonds.npz, %s-edges.dat and %s-elements.dat files." % (output, output, output))
+
+
+def resample(x, y, xnew):
+    '''Return linear interpolation of each row of y (..., len(x)) on grid xnew, nan outside range of x'''
+    lo, hi, t = interp_weights(x, xnew)
+    ynew = y[..., lo] * (1 - t) + y[..., hi] * t
+    ynew[..., (xnew < x[0]) | (xnew > x[-1])] = np.nan
+    return ynew
+
+
+def broaden(energy, curves, width, kind="gaussian"):
+    '''Return curves (..., grid) on uniform energy grid convolved with normalized Gaussian (sigma width)
+       or Lorentzian (half width width) kernel, all rows at once by FFT. Nan points stay nan'''
+    n = len(energy)
+    step = (energy[-1] - energy[0]) / (n - 1)
+    if np.abs(np.diff(energy) - step).max() > 0.01 * abs(step):  # energies are printed with 5 decimals
+        raise ValueError("Energy grid is not uniform: resample curves on energy grid first.")
+    x = np.arange(-(n - 1), n) * step
+    if kind == "lorentzian":
+        kernel = width / (x**2 + width**2)
     else:
-        pass
+        kernel = np.exp(-x**2 / (2 * width**2))
+    kernel /= kernel.sum()  # area of curves is kept
+    size = 1 << int(np.ceil(np.log2(3 * n - 2)))  # linear, not circular convolution
+    missing = np.isnan(curves)
+    spectrum = np.fft.rfft(np.where(missing, 0, curves), size, axis=-1) * np.fft.rfft(kernel, size)
+    result = np.fft.irfft(spectrum, size, axis=-1)[..., n-1:2*n-1]
+    result[missing] = np.nan
+    return result
+
+
+def smooth(energy, curves, smoothing=None, energy_grid=None):
+    '''Return energy and curves (..., grid) resampled on energy grid (Emin, Emax, number of points) and
+       broadened by smoothing (width, kind) if they are given'''
+    energy = np.asarray(energy)
+    if energy_grid is not None:
+        grid = np.linspace(energy_grid[0], energy_grid[1], int(energy_grid[2]))
+        energy, curves = grid, resample(energy, curves, grid)
+    if smoothing is not None and smoothing[0] > 0:
+        curves = broaden(energy, curves, *smoothing)
+    return energy,curves
+
+
+def load_structure(directory, queries, cache=True, window=None):
+    '''Return energy, cohp curves (selection, spin, grid) and icohp values (selection, spin) of
+       selections of queries from COHPCAR.lobster in directory, only in energy window if it is given'''
+    num,titles,cohp = load_cohp(cohpcar_file(directory), cache, window, verbose=False)
+    orbA = list(set([i[0] for i in titles[2:] if type(i) is list]))  # all orbitals in atom 1
+    orbB = list(set([i[1] for i in titles[2:] if type(i) is list]))  # all orbitals in atom 2
+    status,orb_cohp,orb_inp = parse_orb(";".join(queries), orbA, orbB)
+    curves,icohps = get_cohps(num,titles,cohp,orb_cohp)
+    if curves is None:
+        raise ValueError("selected interactions are not in COHPCAR.lobster")
+    return np.array(cohp[0]),curves,icohps
 
+
+def compare(directories, queries, output, workers=None, energy_grid=None, cache=True, formats=(), window=None, smoothing=None):
+    '''Load COHPCAR.lobster of each of directories in parallel processes, evaluate the same selections of
+       queries and write table of icohp (structure, selection) into output-ICOHP.dat, curves resampled
+       on common energy grid (Emin, Emax, number of points) into output-curves.npz and one figure for
+       each structure in each of formats (png, pdf or svg). Curves are broadened by smoothing (width, kind)
+       if it is given'''
+    orb_inp = [q.split() for q in ";".join(queries).split(";") if q.strip()]
+    results = {}
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {directory: pool.submit(load_structure, directory, queries, cache, window) for directory in directories}
+        for directory in directories:
+            try:
+                results[directory] = futures[directory].result()
+                print("COHP of %s is loaded." % directory)
+            except (Exception, SystemExit) as e:  # such as missing file or interaction
+                print("%s is skipped: %s" % (directory, e))
+    if not results:
+        raise SystemExit("No COHPCAR.lobster is loaded!")
+    nspin = max(curves.shape[1] for energy, curves, icohps in results.values())
+    if energy_grid is None:  # common range of all structures
+        energy_grid = (max(energy[0] for energy, curves, icohps in results.values()),
+                       min(energy[-1] for energy, curves, icohps in results.values()),
+                       max(len(energy) for energy, curves, icohps in results.values()))
+    grid = np.linspace(energy_grid[0], energy_grid[1], int(energy_grid[2]))
+    curves_all = np.full((len(directories), len(orb_inp), nspin, len(grid)), np.nan)
+    icohps_all = np.full((len(directories), len(orb_inp), nspin), np.nan)
+    for i, directory in enumerate(directories):
+        if directory in results:
+            energy, curves, icohps = results[directory]
+            curves_all[i, :, :curves.shape[1]] = resample(energy, curves, grid)
+            icohps_all[i, :, :icohps.shape[1]] = icohps
+    grid, curves_all = smooth(grid, curves_all, smoothing)
+    labels = cohp_labels(orb_inp, nspin)
+    width = max(24, max(map(len, directories)) + 2)
+    with open(output+"-ICOHP.dat", 'w') as f:
+        f.write("{:<{}s}".format("# Structure", width) + "".join("{:>16s}".format(x) for x in labels) + "\n")
+        for directory, values in zip(directories, icohps_all.reshape(len(directories), -1)):
+            f.write("{:<{}s}".format(directory, width) + "".join("{:>16.5f}".format(x) for x in values) + "\n")
+    np.savez(output+"-curves.npz", energy=grid, curves=curves_all, icohps=icohps_all,
+             structures=np.array(directories), labels=np.array(labels))
+    print("ICOHP table and COHP curves have been written into %s-ICOHP.dat and %s-curves.npz files." % (output, output))
+    if formats:
+        jobs = [(grid, curves_all[i].reshape(-1, len(grid)), labels,
+                 "%s_%s.%s" % (output, os.path.basename(os.path.normpath(directory)), fmt), directory)
+                for i, directory in enumerate(directories) if directory in results for fmt in formats]
+        for name in plot_jobs(jobs, workers):
+            print("Figure has been written into %s file." % name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Get selected COHP and ICOHP from COHPCAR.lobster file")
+    parser.add_argument("-i", "--input", default=cohpcar_file(""), help="COHPCAR.lobster file, may be compressed (.gz .xz .bz2 .zst)")
+    parser.add_argument("-q", "--query", action="append", default=[], help='selections without prompt, such as "all all;3d 3d;4s 4s"')
+    parser.add_argument("-Q", "--query-file", help="file of selections, one or more (separated by ;) in each line")
+    parser.add_argument("-o", "--output", default="cohp_bulk", help="prefix of output files OUTPUT.dat and OUTPUT-ICOHP.dat")
+    parser.add_argument("-e", "--energies", type=parse_windows, help="ICOHP up to energies or in windows Emin:Emax, such as -e=0,-1,-8:0")
+    parser.add_argument("--integrate", action="store_true", help="integrate COHP for windows instead of reading ICOHP columns")
+    parser.add_argument("-d", "--directories", nargs="+", help="compare the same selections in COHPCAR.lobster of directories (or patterns)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of processes to load directories and plot figures")
+    parser.add_argument("--energy-grid", type=lambda x: tuple(map(float, x.split(":"))), help="resample curves on energy grid Emin:Emax:n, such as --energy-grid=-8:5:1301")
+    parser.add_argument("--broaden", type=float, default=0, help="broaden curves by Gaussian of sigma BROADEN (eV)")
+    parser.add_argument("--lorentzian", action="store_true", help="broaden by Lorentzian of half width BROADEN instead")
+    parser.add_argument("-p", "--plot", type=lambda x: x.split(","), default=[], help="write figures without GUI in formats, such as png or png,pdf,svg")
+    parser.add_argument("-w", "--window", type=lambda x: tuple(map(float, x.split(":"))), help="read only energy window Emin:Emax and selected columns, such as -w=-8:5")
+    parser.add_argument("-b", "--bonds", action="store_true", help="write ICOHP of all atom pairs as sparse atom x atom matrix and element pairs")
+    parser.add_argument("-x", "--explore", action="store_true", help="persistent interactive view with text box of selections")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write sidecar cache")
+    parser.add_argument("--cache-compressed", action="store_true",
+                        help="also write (uncompressed) sidecar cache of compressed COHPCAR.lobster, default: plain files only")
+    args = parser.parse_args()
+    smoothing = (args.broaden, "lorentzian" if args.lorentzian else "gaussian") if args.broaden > 0 else None
+    cache = False if args.no_cache else "all" if args.cache_compressed else True
+
+    queries = args.query
+    if args.query_file:
+        with open(args.query_file) as f:
+            queries = queries + [line.split("#")[0] for line in f if line.split("#")[0].strip()]
+    if args.directories:  # many structures
+        if not queries:
+            parser.error("selections are required by -q or -Q for --directories")
+        directories = [d for pattern in args.directories for d in (sorted(glob.glob(pattern)) or [pattern])]
+        compare(directories, queries, args.output, args.workers, args.energy_grid, cache, args.plot, args.window, smoothing)
+        raise SystemExit
+
+    num,titles,cohp = load_cohp(args.input, cache, args.window)
+    if args.bonds:  # bond network of all atom pairs
+        write_bonds(args.output, *bond_matrix(num, cohp, read_labels(args.input)))
+        if not (queries or args.explore):
+            raise SystemExit
+
+    index = build_index(titles)
+    orbA = list(set([i[0] for i in titles[2:] if type(i) is list]))  # all orbitals in atom 1
+    orbB = list(set([i[1] for i in titles[2:] if type(i) is list]))  # all orbitals in atom 2
+    if queries:  # non-interactive bulk query
+        headless(num,titles,cohp,index,orbA,orbB,queries,args.output,args.energies,args.integrate,args.plot,args.workers,smoothing,args.energy_grid)
+    elif args.explore:
+        from matplotlib import pyplot as plt
+        explorer = CohpExplorer(num,titles,cohp,index,orbA,orbB,smoothing,args.energy_grid)
+        plt.show()
+    else:
+        interactive(num,titles,cohp,index,orbA,orbB,smoothing,args.energy_grid)
@@ -2,31 +2,43 @@
 # Python script to calculate RDF of specified atom and orbital                        ##
 # Written by Yafei Jiang                                                              ##
 # Email: jiangyafei730@163.com                                                        ##
-# Usage: python RDF.py Element Charge Orbital                                         ## 
-# Example: python RDF.py Sc 0 3d                                                   ##
-# After adf calculation is completed, out.Sc will be generated for RDF analysis       ##
+# Usage: python RDF.py Element Charge Orbital [-s submit] [-n workers] [--sweep name] ##
+# Example: python RDF.py Sc 0 3d                                                      ##
+# Example: python RDF.py Sc,Ti,V 0,1 3d,4s -n 4                                       ##
+# Example: python RDF.py Sc 0 3d -s "sh {} &"  (run jobs locally instead of bsub)     ##
+# Example: python RDF.py Sc,Ti,V 0,1,2 3d --sweep row4  (one job array row4[1-9])     ##
+# Example: python RDF.py Sc,Ti,V 0,1,2 3d --sweep row4 --local 4  (without LSF)       ##
+# After adf calculation is completed, Sc/out.Sc will be generated for RDF analysis    ##
+# (Sc_1/out.Sc_1 for Charge 1, each job runs in its own directory)                    ##
+# Example: python RDF.py Sc 0 3d --t21  (read Sc/t21.Sc, no eigenvectors printed)     ##
+# Note: RDF_analysis.py should be placed in the same directory                        ##
 ########################################################################################
-import sys,os,time
+import os,time
+import select
+import struct
+import ctypes, ctypes.util
+import argparse
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
-import math
+from RDF_analysis import read_adf, select_orbitals, calc_orbitals, write_rdf
 
 
-Element = sys.argv[1]
-Charge = sys.argv[2]
-# Orbital = sys.argv[3]
-# ADF input file
-adfinp='''$ADFBIN/adf -n 10 << eor   1>out.{0}  2>eor.{0}
+# Print of eigenvectors into out.jobname, not needed if RDF is calculated from t21.jobname
+eprint='''EPRINT
+OrbPopER -50 10
+SCF Print Eigvec
+END
+'''
+
+# ADF input file: {0} Element, {1} Charge, {2} job name, {3} print options
+adfinp='''$ADFBIN/adf -n 10 << eor   1>out.{2}  2>eor.{2}
 ATOMS
 {0}       0.000000    0.000000    0.000000
 END
 CHARGE   {1}
 Occupations Smear=0.01
-EPRINT
-OrbPopER -50 10
-SCF Print Eigvec
-END
-XC
+{3}XC
 GGA PBE
 END
 !Relativistic SpinOrbit ZORA
@@ -42,23 +54,20 @@ CORE none
 END
 END INPUT
 eor
-mv -f TAPE21 t21.{0}
-'''.format(Element,Charge)
-with open(Element+".run", 'w') as f:
-    f.write(adfinp)
+mv -f TAPE21 t21.{2}
+'''
 
-# ADF sumbit script
+# ADF sumbit script: {2} job name, {3} LSF job name, {4} suffix of LSF output, {5} directory of job
 adfsub='''#!/bin/bash
 #BSUB -q debug
 #BSUB -n 40
-#BSUB -e %J.err
-#BSUB -o %J.out
+#BSUB -e %J{4}.err
+#BSUB -o %J{4}.out
 #BSUB -R "span[ptile=40]"
-#BSUB -J test-RDF
+#BSUB -J {3}
 hostfile=`echo $LSB_DJOB_HOSTFILE`
 NP=`cat $hostfile | wc -l`
 cd $LS_SUBCWD
-echo -n "start time  " > time ; date >> time
 #-------------intelmpi+ifort------------------------------------------
 source /share/intel/2017u8/compilers_and_libraries_2017.8.262/linux/bin/compilervars.sh -arch intel64 -platform linux
 source /share/intel/2017u8/compilers_and_libraries_2017.8.262/linux/mpi/intel64/bin/mpivars.sh intel64
@@ -69,154 +78,181 @@ ADFRESOURCES=$ADFHOME/atomicdata
 SCMLICENSE=$ADFHOME/license.txt
 export ADFHOME ADFBIN ADFRESOURCES SCMLICENSE
 export PATH=$PATH:$ADFBIN
-JOBNAME={0}
+JOBNAME={2}
+cd ./{5}
+echo -n "start time  " > time ; date >> time
 dos2unix ./$JOBNAME.run
 chmod 700 ./$JOBNAME.run
-mkdir $GAUSS_SCRDIR/$JOBNAME
-export SCM_TMPDIR=$GAUSS_SCRDIR/$JOBNAME
+SCRATCH=$GAUSS_SCRDIR/${{LSB_JOBID:-$$}}_${{LSB_JOBINDEX:-0}}_$JOBNAME  # unique for each job
+mkdir -p $SCRATCH
+export SCM_TMPDIR=$SCRATCH
 ./$JOBNAME.run >$JOBNAME.out
 mv TAPE21 $JOBNAME.t21
 mv logfile $JOBNAME.logfile
 echo -n "end   time  " >> time ; date >> time
-rm -rf $GAUSS_SCRDIR/$JOBNAME
-'''.format(Element)
-with open("adf.sh", 'w') as f:
-    f.write(adfsub)
-
-# Run ADF software: bsub command, or using qsub command
-subprocess.run("bsub < adf.sh",shell=True)
-
-test="{}.logfile".format(Element)
-while True:
-    if os.path.isfile(test):
-        ## 1. Extract (basis "z", coefficient "c", mainquantumnumber "N" from output file of ADF
-        file_name="out."+Element
-        orbital=sys.argv[3]
-        file_out=open(file_name,'r')
-        lines=file_out.readlines()
-        
-        status1,line1 = subprocess.getstatusoutput("sed -n '/Valence Basis Sets/=' " + file_name)
-        line_basis=int(line1.split('\n')[0])
-        Nbasis=int(lines[line_basis-1].split()[-1].split('\n')[0])  # Numbers of valence basis sets
-        basis=[]  # all zeta value of valence basis set 
-        mainquantumnumber=[]  # corresponding main quantum number
-        orbitals=[]  # corresponding orbital: S P D F
-        for i in range(Nbasis):
-            basis.append(float(lines[line_basis+1+i].split()[2]))
-            mainquantumnumber.append(int(lines[line_basis+1+i].split()[0]))
-            orbitals.append(lines[line_basis+1+i].split()[1])
-        
-        # status2,line2 = subprocess.getstatusoutput("sed -n '/=== S ===/=' " + file_name)
-        # status3,line3 = subprocess.getstatusoutput("sed -n '/=== P:y ===/=' " + file_name)
-        # status4,line4 = subprocess.getstatusoutput("sed -n '/=== D:xz ===/=' " + file_name)
-        # status5,line5 = subprocess.getstatusoutput("sed -n '/=== F:xyz ===/=' " + file_name)
-        
-        orbital_dic={"S":0,"P":1,"D":2,"F":3}
-        # orbital="6p"
-        orbital_n = int(orbital[0])  # The main quantum number of orbital you input
-        orbital_ch = orbital[1].upper()  # The angular quantum number of orbital you input
-        orbital_l = orbital_dic[orbital_ch] # The angular quantum number of orbital you input
-        
-        c=[]  #coefficient matrix
-        if orbital_ch == "F":
-            status5,line5 = subprocess.getstatusoutput("sed -n '/=== F:xyz ===/=' " + file_name)
-            if status5 == 0:
-                column = orbital_n - orbital_l
-                line_coeff=int(line5.split('\n')[1])
-                f_index = [i for i in range(len(orbitals)) if orbitals[i] == orbital_ch]
-                z=[basis[i] for i in f_index]
-                N=[mainquantumnumber[i] for i in f_index]
-                for i in range(len(z)):
-                    c.append(float(lines[line_coeff+6+i].split()[column]))
-        
-        elif orbital_ch == "D":
-            status4,line4 = subprocess.getstatusoutput("sed -n '/=== D:xz ===/=' " + file_name)
-            if status4 == 0:
-                column = orbital_n - orbital_l
-                line_coeff=int(line4.split('\n')[1])
-                d_index = [i for i in range(len(orbitals)) if orbitals[i] == orbital_ch]
-                z=[basis[i] for i in d_index]
-                N=[mainquantumnumber[i] for i in d_index]
-                for i in range(len(z)):
-                    c.append(float(lines[line_coeff+6+i].split()[column]))
-        
-        elif orbital_ch == "P":
-            status3,line3 = subprocess.getstatusoutput("sed -n '/=== P:y ===/=' " + file_name)
-            if status3 == 0:
-                column = orbital_n - orbital_l
-                line_coeff=int(line3.split('\n')[1])
-                p_index = [i for i in range(len(orbitals)) if orbitals[i] == orbital_ch]
-                z=[basis[i] for i in p_index]
-                N=[mainquantumnumber[i] for i in p_index]
-                if column < 5:
-                    for i in range(len(z)):
-                        c.append(float(lines[line_coeff+6+i].split()[column]))
-                else:
-                    column = column - 4
-                    for i in range(len(z)):
-                        c.append(float(lines[line_coeff+6+i+len(z)+3].split()[column]))
-        
-        elif orbital_ch == "S":
-            status2,line2 = subprocess.getstatusoutput("sed -n '/=== S ===/=' " + file_name)
-            if status2 == 0:
-                column = orbital_n - orbital_l
-                line_coeff=int(line2.split('\n')[1])
-                s_index = [i for i in range(len(orbitals)) if orbitals[i] == orbital_ch]
-                z=[basis[i] for i in s_index]
-                N=[mainquantumnumber[i] for i in s_index]
-                if column < 5:
-                    for i in range(len(z)):
-                        c.append(float(lines[line_coeff+6+i].split()[column]))
-                else:
-                    column = column - 4
-                    for i in range(len(z)):
-                        c.append(float(lines[line_coeff+6+i+len(z)+3].split()[column]))
-        
-        else:
-            print("The orbital you input is not correct.")
-            sys.exit()
-        	
-        ####################################################################################
-        # 2. Calculate RDF of specified atom and orbital
-        ####################################################################################
-        
-        # z=np.loadtxt('basis.txt')  #sita
-        # c=np.loadtxt('coefficient.txt')  #coefficient matrix
-        # N=np.loadtxt('mainquantumnumber.txt')  #main quantum number of sita
-        M=len(z);
-        
-        # AO nomalization coefficient
-        b=np.zeros(M)
-        for i in range(M):
-            b[i]=(2 * z[i])**(N[i] + 0.5) / (math.factorial(2 * N[i]))**0.5
-            
-        # MO nomalization coefficient
-        V=0
-        for i in range(M):
-            for j in range(M):
-                V = V + math.factorial(N[i]+N[j]) * b[i] * b[j] * c[i] * c[j] / (z[i] + z[j]) ** ( N[i] + N[j] + 1)
-        
-        grid=800        
-        D_r=np.zeros(grid)  
-        r=np.zeros(grid)    
-        for m in range(grid):
-            r[m]= m / 100  # radial variable 
-            sumsum=0;
-            for p in range(M):
-                for q in range(M):
-                    sumpq=(1/V)*r[m]**2*c[p]*c[q]*b[p]*b[q]*(r[m]**(N[p]-1)* np.exp(-z[p]*r[m]))*(r[m]**(N[q]-1)* np.exp(-z[q]*r[m]));
-                # AO:f1(r)=r^(N-1)*exp(-z(i,1)*r)  MO:f2(r)=E*sum(C(1,i)*f1)
-                # F(r)=r^2*f2^2
-                    sumsum=sumsum+sumpq;
-            D_r[m]=sumsum
-        
-        bohr2A=0.529
-        with open(file_name.split(".")[1] + "_" + orbital + "-RDF.dat", 'w') as f:
-            for i in range(len(r)):
-                f.write("{:^10.6f}{:^10.6f}\n".format(r[i] * bohr2A, D_r[i]))
-                	
-        print("RDF calcuation is finished.")  
-        break
+rm -rf $SCRATCH
+'''
+
+
+def job_name(Element, Charge):
+    '''Return job name of Element with Charge, such as Sc or Sc_1'''
+    return Element if float(Charge) == 0 else Element + "_" + Charge
+
+
+def submit(Element, Charge, command="bsub < {}", t21=False):
+    '''Write ADF input file and sumbit script of Element with Charge into its own directory jobname
+       (ADF always writes TAPE21 and logfile there), then run command in it to submit it.
+       Eigenvectors are not printed into output file if t21 is True. Return job jobname/jobname,
+       or None if command failed'''
+    jobname = job_name(Element, Charge)
+    os.makedirs(jobname, exist_ok=True)
+    with open(os.path.join(jobname, jobname+".run"), 'w') as f:
+        f.write(adfinp.format(Element,Charge,jobname,"" if t21 else eprint))
+    with open(os.path.join(jobname, jobname+".sh"), 'w') as f:
+        f.write(adfsub.format(Element,Charge,jobname,"test-RDF","",""))
+    env = dict(os.environ, LS_SUBCWD=os.path.abspath(jobname))  # set by LSF itself, needed by local commands
+    if subprocess.run(command.replace("{}", jobname+".sh"),shell=True,cwd=jobname,env=env).returncode != 0:
+        print("Submission of %s is failed." % jobname)
+        return None
+    return os.path.join(jobname, jobname)
+
+
+def run_local(script, directory, env, output):
+    '''Run script in directory with environment env and write its output into file output'''
+    with open(os.path.join(directory, output), 'w') as out:
+        subprocess.run(["bash", script], cwd=directory, env=env, stdout=out, stderr=subprocess.STDOUT)
+
+
+def submit_sweep(name, jobs, command="bsub < {}", local=0, t21=False):
+    '''Write ADF input file of each (Element, Charge) of jobs into its own directory name/jobname and
+       submit all of them as one job array name[1-N] by command, or run them with local processes
+       if local > 0. Return list of jobs name/jobname/jobname, or empty list if command failed'''
+    jobnames = []
+    for Element, Charge in jobs:
+        jobname = job_name(Element, Charge)
+        os.makedirs(os.path.join(name, jobname), exist_ok=True)
+        with open(os.path.join(name, jobname, jobname+".run"), 'w') as f:
+            f.write(adfinp.format(Element,Charge,jobname,"" if t21 else eprint))
+        jobnames.append(jobname)
+    with open(os.path.join(name, "jobs.txt"), 'w') as f:  # job of index $LSB_JOBINDEX in job array
+        f.write("\n".join(jobnames) + "\n")
+    script = os.path.basename(os.path.abspath(name))
+    with open(os.path.join(name, script+".sh"), 'w') as f:
+        f.write(adfsub.format("", "", '`sed -n "${LSB_JOBINDEX}p" jobs.txt`', "%s[1-%d]" % (script, len(jobnames)), ".%I", "$JOBNAME"))
+    if local > 0:  # local executor instead of LSF
+        executor = ThreadPoolExecutor(local)
+        for i in range(1, len(jobnames) + 1):
+            env = dict(os.environ, LSB_JOBINDEX=str(i), LS_SUBCWD=os.path.abspath(name))
+            executor.submit(run_local, script+".sh", name, env, "%s.%d.out" % (script, i))
+        executor.shutdown(wait=False)
+    elif subprocess.run(command.replace("{}", script+".sh"), shell=True, cwd=name).returncode != 0:
+        print("Submission of job array %s is failed." % script)
+        return []
+    return [os.path.join(name, jobname, jobname) for jobname in jobnames]
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+
+def wait_files(paths, poll=5):
+    '''Yield paths of files as soon as they are written. Files are checked every poll seconds, and
+       inotify on their directories wakes up earlier for files written by this host'''
+    pending = set(paths)
+    fd = -1
+    directories = {}  # watch descriptor: directory
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        for directory in set(os.path.dirname(path) for path in pending):
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory or "."), IN_CLOSE_WRITE | IN_MOVED_TO) if fd >= 0 else -1
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch")
+            directories[wd] = directory
+    except (OSError, AttributeError, TypeError):  # no inotify, use polling
+        if fd >= 0:
+            os.close(fd)
+        fd = -1
+    try:
+        while pending:
+            for path in sorted(pending):  # files written before watching
+                if os.path.isfile(path):
+                    pending.remove(path)
+                    yield path
+            if not pending:
+                break
+            if fd < 0:
+                print("Please waiting for ADF calculation...")
+                time.sleep(poll)
+                continue
+            if not select.select([fd], [], [], poll)[0]:  # no event, files written by other hosts (NFS)
+                continue
+            buf = os.read(fd, 65536)
+            i = 0
+            while i < len(buf):
+                wd, mask, cookie, length = struct.unpack_from("iIII", buf, i)
+                path = os.path.join(directories.get(wd, ""), buf[i+16:i+16+length].rstrip(b"\0").decode())
+                i += 16 + length
+                if path in pending:
+                    pending.remove(path)
+                    yield path
+    finally:
+        if fd >= 0:
+            os.close(fd)
+
+
+def analyse(job, orbital, t21=False):
+    '''Calculate RDF of orbital(s) from out.jobname (or t21.jobname) in directory of job and write them into file'''
+    ## 1. Extract (basis "z", coefficient "c", mainquantumnumber "N" from output file (or TAPE21) of ADF
+    directory, jobname = os.path.split(job)
+    file_name=os.path.join(directory, ("t21." if t21 else "out.")+jobname)
+    data = read_adf(file_name)
+    selected = select_orbitals(data, orbital if orbital == "all" else orbital.split(","))
+
+    ####################################################################################
+    # 2. Calculate RDF of specified atom and orbital
+    ####################################################################################
+    grid=800
+    r = np.arange(grid) / 100  # radial variable
+    D_r = calc_orbitals(data, selected, r)
+    if len(selected) == 1:
+        output = job + "_" + orbital + "-RDF.dat"
+        write_rdf(output, r, D_r)
     else:
-        print("Please waiting for ADF calculation...")
-        time.sleep(5) # waiting 20s to run ADF software
\ No newline at end of file
+        output = job + "-RDF.dat"
+        write_rdf(output, r, D_r, [s[0] for s in selected])
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run ADF calculations and calculate RDF of specified atoms and orbitals")
+    parser.add_argument("Element", help="element(s), such as Sc or Sc,Ti,V")
+    parser.add_argument("Charge", help="charge(s), such as 0 or 0,1")
+    parser.add_argument("Orbital", help="orbital(s), such as 3d, 3d,4s or all")
+    parser.add_argument("-s", "--submit", default="bsub < {}", help="command to submit script {}, default: bsub < {}")
+    parser.add_argument("-n", "--workers", type=int, default=None, help="number of processes for RDF analysis")
+    parser.add_argument("--sweep", help="create directory SWEEP/job for each job and submit them as one job array")
+    parser.add_argument("--local", type=int, default=0, help="run job array of sweep with LOCAL local processes instead of LSF")
+    parser.add_argument("--t21", action="store_true", help="read orbitals from TAPE21 t21.job instead of printing them into out.job")
+    parser.add_argument("-p", "--poll", type=float, default=5, help="polling interval (s) of finished jobs, default: 5")
+    args = parser.parse_args()
+
+    # Run ADF software: bsub command, or using qsub command
+    pairs = [(Element, Charge) for Element in args.Element.split(",") for Charge in args.Charge.split(",")]
+    if args.sweep:
+        jobs = submit_sweep(args.sweep, pairs, args.submit, args.local, args.t21)
+    else:
+        jobs = [submit(Element, Charge, args.submit, args.t21) for Element, Charge in pairs]
+        jobs = [job for job in jobs if job is not None]  # submitted jobs only
+
+    with ProcessPoolExecutor(args.workers) as pool:
+        futures = {}
+        for name in wait_files([job+".logfile" for job in jobs], poll=args.poll):
+            job = name[:-len(".logfile")]
+            print("ADF calculation of %s is finished." % job)
+            futures[job] = pool.submit(analyse, job, args.Orbital, args.t21)
+        for job in jobs:
+            try:
+                print("RDF calcuation of %s is finished: %s" % (job, futures[job].result()))
+            except (Exception, SystemExit) as error:
+                print("RDF calcuation of %s is failed: %r" % (job, error))
@@ -2,143 +2,795 @@
 # Python script to calculate RDF of specified atom and orbital                        ##
 # Written by Yafei Jiang                                                              ##
 # Email: jiangyafei730@163.com                                                        ##
-# Usage: python RDF_analysis.py filename orbital                                               ## 
-# Example: python RDF_analysis.py out.Os 5d                                                           ##
-# Note: the file such as out.Os should be obtained from ADF calculation               ##                                                           ##
+# Usage: python RDF_analysis.py filename orbital [grid] [rmax] [-m mode] [-t tol]     ##
+# Example: python RDF_analysis.py out.Os 5d                                           ##
+# Example: python RDF_analysis.py out.Os 5d 100000 8                                  ##
+# Example: python RDF_analysis.py out.Os 4f,5d,6s,6p  (or all for all orbitals)       ##
+# Example: python RDF_analysis.py out.Os all -m adaptive -t 1e-6                      ##
+# Example: python RDF_analysis.py out.Os all -m analytic -k=-1,1,2 -o out.Os_1        ##
+# Example: python RDF_analysis.py out.Os all -f npz  (read by load_rdf("Os-RDF.npz")) ##
+# Example: python RDF_analysis.py "out.*" 5d,6s -j 8  (or @list.txt: file orbital)    ##
+# Example: python RDF_analysis.py out.Os 5d -c --cube-points 200 --density            ##
+# Example: python RDF_analysis.py t21.Os 5d  (binary TAPE21, read without dmpkf)      ##
+# Note: the file such as out.Os should be obtained from ADF calculation               ##
+# Note: parsed data is cached in ~/.cache/rdf_analysis (or $RDF_CACHE)                ##
 ########################################################################################
 import sys
+import os
+import re
+import json
+import hashlib
+import glob
+import argparse
+import mmap
 import subprocess
+import shutil
+import struct
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import math
 
-## 1. Extract (basis "z", coefficient "c", mainquantumnumber "N" from output file of ADF
-file_name=sys.argv[1]
-orbital=sys.argv[2]
-file_out=open(file_name,'r')
-lines=file_out.readlines()
-
-status1,line1 = subprocess.getstatusoutput("sed -n '/Valence Basis Sets/=' " + file_name)
-# print(status1)
-line_basis=int(line1.split('\n')[0])
-Nbasis=int(lines[line_basis-1].split()[-1].split('\n')[0])  # Numbers of valence basis sets
-basis=[]  # all zeta value of valence basis set 
-mainquantumnumber=[]  # corresponding main quantum number
-orbitals=[]  # corresponding orbital: S P D F
-for i in range(Nbasis):
-    basis.append(float(lines[line_basis+1+i].split()[2]))
-    mainquantumnumber.append(int(lines[line_basis+1+i].split()[0]))
-    orbitals.append(lines[line_basis+1+i].split()[1])
-
-# status2,line2 = subprocess.getstatusoutput("sed -n '/=== S ===/=' " + file_name)
-# status3,line3 = subprocess.getstatusoutput("sed -n '/=== P:y ===/=' " + file_name)
-# status4,line4 = subprocess.getstatusoutput("sed -n '/=== D:xz ===/=' " + file_name)
-# status5,line5 = subprocess.getstatusoutput("sed -n '/=== F:xyz ===/=' " + file_name)
 
 orbital_dic={"S":0,"P":1,"D":2,"F":3}
-# orbital="6p"
-orbital_n = int(orbital[0])  # The main quantum number of orbital you input
-orbital_ch = orbital[1].upper()  # The angular quantum number of orbital you input
-orbital_l = orbital_dic[orbital_ch] # The angular quantum number of orbital you input
-
-c=[]  #coefficient matrix
-if orbital_ch == "F":
-    status5,line5 = subprocess.getstatusoutput("sed -n '/=== F:xyz ===/=' " + file_name)
-    if status5 == 0:
-        column = orbital_n - orbital_l
-        line_coeff=int(line5.split('\n')[1])
-        f_index = [i for i in range(len(orbitals)) if orbitals[i] == orbital_ch]
-        z=[basis[i] for i in f_index]
-        N=[mainquantumnumber[i] for i in f_index]
-        for i in range(len(z)):
-            c.append(float(lines[line_coeff+6+i].split()[column]))
-
-elif orbital_ch == "D":
-    status4,line4 = subprocess.getstatusoutput("sed -n '/=== D:xz ===/=' " + file_name)
-    if status4 == 0:
-        column = orbital_n - orbital_l
-        line_coeff=int(line4.split('\n')[1])
-        d_index = [i for i in range(len(orbitals)) if orbitals[i] == orbital_ch]
-        z=[basis[i] for i in d_index]
-        N=[mainquantumnumber[i] for i in d_index]
-        for i in range(len(z)):
-            c.append(float(lines[line_coeff+6+i].split()[column]))
-
-elif orbital_ch == "P":
-    status3,line3 = subprocess.getstatusoutput("sed -n '/=== P:y ===/=' " + file_name)
-    if status3 == 0:
-        column = orbital_n - orbital_l
-        line_coeff=int(line3.split('\n')[1])
-        p_index = [i for i in range(len(orbitals)) if orbitals[i] == orbital_ch]
-        z=[basis[i] for i in p_index]
-        N=[mainquantumnumber[i] for i in p_index]
-        if column < 5:
-            for i in range(len(z)):
-                c.append(float(lines[line_coeff+6+i].split()[column]))
-        else:
-            column = column - 4
-            for i in range(len(z)):
-                c.append(float(lines[line_coeff+6+i+len(z)+3].split()[column]))
+# section markers of MO coefficients in output file of ADF
+markers={"S":b"=== S ===","P":b"=== P:y ===","D":b"=== D:xz ===","F":b"=== F:xyz ==="}
+marker_re=re.compile(rb"Valence Basis Sets|=== (?:S|P:y|D:xz|F:xyz) ===")
+bohr2A=0.529
+
+
+def index_sections(mm):
+    '''Return byte offsets of the lines of all section markers found in a single pass over mm'''
+    offsets={}
+    for m in marker_re.finditer(mm):
+        offsets.setdefault(m.group(), []).append(mm.rfind(b"\n", 0, m.start()) + 1)
+    return offsets
+
+
+def read_block(mm, nrow, labels=None):
+    '''Read nrow coefficient rows from current position of mm, return labels and coefficients of rows
+       or None if they are not found'''
+    rows = [mm.readline().split() for i in range(nrow)]
+    if labels is not None and [row[:1] for row in rows] != labels:
+        return None
+    try:
+        return [row[:1] for row in rows], np.array([row[1:] for row in rows], dtype=float)
+    except ValueError:
+        return None
+
+
+# irreps of atom in TAPE21 with the same components as the text output
+irreps={"S":"S","P":"P:y","D":"D:xz","F":"F:xyz"}
+
+
+def is_kf(file_name):
+    '''Return True if file is a binary KF file of ADF such as TAPE21 (t21.Os)'''
+    with open(file_name, 'rb') as f:
+        return b"SUPERINDEX" in f.read(128)
+
+
+def parse_dmpkf(text):
+    '''Return {"Section%variable": array} of integer and real variables in text output of dmpkf'''
+    data = {}
+    lines = text.splitlines()
+    i = 0
+    while i + 2 < len(lines):
+        if not lines[i].strip():
+            i += 1
+            continue
+        section, variable = lines[i].strip(), lines[i+1].strip()
+        n, length, vtype = map(int, lines[i+2].split()[:3])
+        i += 3
+        values = []
+        while len(values) < n and i < len(lines):
+            values.extend(lines[i].split())
+            i += 1
+        if vtype == 1:
+            data[section+"%"+variable] = np.array(values, dtype=int)
+        elif vtype == 2:
+            data[section+"%"+variable] = np.array([v.replace("D", "E") for v in values], dtype=float)
+    return data
+
+
+def kf_format(head):
+    '''Return block size and integer dtype (4 or 8 bytes, little or big endian) of KF file from its first
+       128 bytes, or None if the format is not recognized'''
+    for size, offset in ((4, 48), (8, 64)):  # name of second superindex record
+        if head[offset:offset+32].rstrip(b" ") == b"SUPERINDEX":
+            break
+    else:
+        return None
+    for endian in "<>":
+        dtype = np.dtype(endian + "i%d" % size)
+        if np.frombuffer(head, dtype, 1, offset + 32)[0] == 1:  # superindex is in block 1
+            break
+    else:
+        return None
+    blocksize = 4096 if head[28:32] == b"    " else int(np.frombuffer(head, endian + "i4", 1, 28)[0])
+    return blocksize, dtype
+
+
+def kf_index(f, blocksize, dtype):
+    '''Return variables {section: {variable: (type, logical block, start, length)}} and data blocks
+       {section: [(logical block, physical block, number of blocks)]} from superindex and index blocks'''
+    record = np.dtype([("name", "S32"), ("value", dtype, 4)])  # physical block, logical block, length, type
+    entry = np.dtype([("name", "S32"), ("value", dtype, 6)])  # logical block, start, length, -, used, type
+    header = 32 + 7 * dtype.itemsize  # of index block
+    records = []
+    block, visited = 1, set()
+    while block not in visited:  # chain of superindex blocks, the first record points to the next one
+        visited.add(block)
+        f.seek((block - 1) * blocksize)
+        records.append(np.frombuffer(f.read(blocksize), record, blocksize // record.itemsize))
+        block = int(records[-1]["value"][0, 3])
+    records = np.concatenate(records)
+    variables, blocks = {}, {}
+    for name, (physical, logical, length, kind) in zip(records["name"], records["value"].tolist()):
+        name = name.decode("latin-1").rstrip()
+        if name in ("SUPERINDEX", "EMPTY"):
+            continue
+        if kind == 4:  # data blocks
+            blocks.setdefault(name, []).append((logical, physical, length))
+        elif kind == 3:  # index blocks
+            f.seek((physical - 1) * blocksize)
+            data = f.read(length * blocksize)
+            for i in range(length):
+                entries = np.frombuffer(data, entry, (blocksize - header) // entry.itemsize, i * blocksize + header)
+                for var, (vlb, vstart, vlen, unused, vused, vtype) in zip(entries["name"], entries["value"].tolist()):
+                    var = var.decode("latin-1").rstrip()
+                    if var != "EMPTY":
+                        variables.setdefault(name, {})[var] = (vtype, vlb, vstart, vused)
+    return variables, blocks
+
+
+def kf_variable(f, blocksize, dtype, blocks, info):
+    '''Return array of variable with info (type, logical block, start, length) from data blocks
+       [(logical block, physical block, number of blocks)] of its section. Each data block holds
+       integers, reals, characters and logicals after a header of their numbers'''
+    vtype, logical, start, length = info
+    size = dtype.itemsize
+    parts, count = [], 1 - start  # values before start of variable in its first block
+    for lb, pb, nb in sorted(blocks):
+        for i in range(max(logical - lb, 0), nb):
+            f.seek((pb + i - 1) * blocksize)
+            data = f.read(blocksize)
+            ni, nd, ns, nl = np.frombuffer(data, dtype, 4).tolist()
+            offset = 4 * size
+            if vtype == 1:
+                part = np.frombuffer(data, dtype, ni, offset)
+            elif vtype == 2:
+                part = np.frombuffer(data, dtype.byteorder.replace("=", "<") + "f8", nd, offset + ni * size)
+            elif vtype == 3:
+                part = np.frombuffer(data, "S1", ns, offset + ni * size + nd * 8)
+            else:
+                part = np.frombuffer(data, dtype, nl, offset + ni * size + nd * 8 + ns) != 0
+            parts.append(part)
+            count += len(part)
+            if count >= length:
+                values = np.concatenate(parts)[start-1:start-1+length]
+                return b"".join(values).decode("latin-1") if vtype == 3 else values
+    raise ValueError("Data of variable is incomplete in KF file.")
+
+
+def read_kf(file_name, variables):
+    '''Return {"Section%variable": array} of variables of KF file, read directly from its binary blocks.
+       dmpkf of ADF is used only if the format is not recognized. Missing variables are skipped'''
+    with open(file_name, 'rb') as f:
+        fmt = kf_format(f.read(128))
+        if fmt is not None:
+            blocksize, dtype = fmt
+            index, blocks = kf_index(f, blocksize, dtype)
+            data = {}
+            for variable in variables:
+                section, name = variable.split("%", 1)
+                if name in index.get(section, {}):
+                    data[variable] = kf_variable(f, blocksize, dtype, blocks[section], index[section][name])
+            return data
+    dmpkf = shutil.which("dmpkf", path=os.environ.get("ADFBIN")) or shutil.which("dmpkf")
+    if dmpkf is None:
+        raise RuntimeError("Format of KF file %s is not recognized and dmpkf of ADF is not found in $ADFBIN." % file_name)
+    output = subprocess.run([dmpkf, file_name] + list(variables), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if output.returncode != 0:
+        raise ValueError("dmpkf failed to read %s: %s" % (file_name, output.stderr.strip()))
+    return parse_dmpkf(output.stdout)
 
-elif orbital_ch == "S":
-    status2,line2 = subprocess.getstatusoutput("sed -n '/=== S ===/=' " + file_name)
-    if status2 == 0:
+
+def read_t21(file_name):
+    '''Extract basis "zeta", mainquantumnumber "N", angular quantum number "l" and
+       coefficient matrix of S P:y D:xz F:xyz from TAPE21 (t21.Os) of ADF'''
+    kf = read_kf(file_name, ["Basis%nqbas", "Basis%lqbas", "Basis%alfbas"])
+    if "Basis%alfbas" not in kf:
+        raise ValueError("Basis is not found in %s." % file_name)
+    data = {"zeta": kf["Basis%alfbas"].astype(float).ravel(),
+            "N": kf["Basis%nqbas"].astype(int).ravel(),
+            "l": kf["Basis%lqbas"].astype(int).ravel(),
+            "coeff": {}}
+    ncart = np.array([1, 3, 6, 10])[data["l"]]  # number of cartesian functions of each STO
+    first = np.cumsum(ncart) - ncart  # index of first cartesian function of each STO
+    present = [ch for ch, l in orbital_dic.items() if np.any(data["l"] == l)]
+    kf = read_kf(file_name, [irreps[ch] + "%" + v for ch in present for v in ("npart", "Eigen-Bas_A")])
+    for ch in present:
+        if irreps[ch] + "%Eigen-Bas_A" not in kf:
+            continue
+        l = orbital_dic[ch]
+        npart = kf[irreps[ch] + "%npart"].astype(int).ravel() - 1  # cartesian functions of this irrep
+        sto = np.searchsorted(first, npart, side="right") - 1
+        keep = data["l"][sto] == l  # xx, yy, zz of d in S (yyy, xxy, yzz of f in P:y) are skipped
+        rank = np.cumsum(data["l"] == l) - 1  # row of STO in coefficient matrix of l
+        eigen = kf[irreps[ch] + "%Eigen-Bas_A"].astype(float).ravel()
+        coeff = np.zeros((int(np.count_nonzero(data["l"] == l)), len(eigen) // len(npart)))
+        coeff[rank[sto[keep]]] = eigen.reshape(-1, len(npart)).T[keep]  # Fortran order: nbas x nmo
+        data["coeff"][ch] = coeff
+    return data
+
+
+def read_adf(file_name):
+    '''Extract basis "zeta", mainquantumnumber "N", angular quantum number "l" and
+       coefficient matrix of S P:y D:xz F:xyz from output file (or TAPE21) of ADF'''
+    if is_kf(file_name):
+        return read_t21(file_name)
+    with open(file_name, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offsets = index_sections(mm)
+            if b"Valence Basis Sets" not in offsets:
+                raise ValueError("Valence Basis Sets are not found in %s." % file_name)
+            mm.seek(offsets[b"Valence Basis Sets"][0])
+            Nbasis = int(mm.readline().split()[-1])  # Numbers of valence basis sets
+            mm.readline()
+            rows = [mm.readline().split() for i in range(Nbasis)]
+            data = {"zeta": np.array([row[2] for row in rows], dtype=float),  # all zeta value of valence basis set
+                    "N": np.array([row[0] for row in rows], dtype=int),  # corresponding main quantum number
+                    "l": np.array([orbital_dic[row[1].decode().upper()] for row in rows], dtype=int),  # S P D F
+                    "coeff": {}}
+            for ch, marker in markers.items():
+                if len(offsets.get(marker, [])) < 2:
+                    continue
+                nrow = int(np.count_nonzero(data["l"] == orbital_dic[ch]))
+                mm.seek(offsets[marker][1])
+                for i in range(7):  # marker and header lines
+                    mm.readline()
+                block = read_block(mm, nrow)
+                if block is None:
+                    raise ValueError("Coefficients after %s are not found in %s." % (marker.decode(), file_name))
+                labels, block = block
+                blocks = [block]
+                while True:  # coefficients of higher orbitals are wrapped after 3 lines
+                    for i in range(3):
+                        mm.readline()
+                    block = read_block(mm, nrow, labels)
+                    if block is None:
+                        break
+                    blocks.append(block[1])
+                data["coeff"][ch] = np.hstack(blocks)
+        finally:
+            mm.close()
+    return data
+
+
+cache_version = "1"  # change it when format of parsed data is changed
+cache_dir = os.environ.get("RDF_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "rdf_analysis"))
+
+
+def file_hash(file_name, blocksize=1 << 24):
+    '''Return content hash of file'''
+    h = hashlib.blake2b(cache_version.encode(), digest_size=16)
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def write_json(file_name, obj):
+    '''Write obj into json file atomically'''
+    tmp = "%s.%d.tmp" % (file_name, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, file_name)
+
+
+def read_json(file_name):
+    '''Return object of json file, or empty dict if it is missing or broken'''
+    try:
+        with open(file_name) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def read_adf_cached(file_name, directory=None, max_size=1 << 30):
+    '''Return data of read_adf from cache directory keyed by file size, mtime and content hash,
+       parse output file of ADF and store the data if it is not cached.
+       Least recently used entries (and their paths in index) are removed when the cache is larger
+       than max_size bytes. Entries removed by other processes at the same time are parsed again'''
+    directory = directory or cache_dir
+    os.makedirs(directory, exist_ok=True)
+    index_file = os.path.join(directory, "index.json")
+    index = read_json(index_file)
+    path = os.path.abspath(file_name)
+    stat = os.stat(path)
+    key = index.get(path)
+    if key is None or key[:2] != [stat.st_size, stat.st_mtime_ns]:  # unknown or modified file
+        key = [stat.st_size, stat.st_mtime_ns, file_hash(path)]
+        index[path] = key
+        write_json(index_file, index)
+    entry = os.path.join(directory, key[2] + ".npz")
+    try:
+        os.utime(entry)  # mark as recently used
+        with np.load(entry) as npz:
+            data = {name: npz[name] for name in ("zeta", "N", "l")}
+            data["coeff"] = {name[6:]: npz[name] for name in npz.files if name.startswith("coeff_")}
+        return data
+    except FileNotFoundError:  # not cached, or removed by another process
+        pass
+
+    data = read_adf(file_name)
+    tmp = "%s.%d.tmp.npz" % (entry[:-4], os.getpid())
+    np.savez(tmp, zeta=data["zeta"], N=data["N"], l=data["l"],
+             **{"coeff_" + ch: c for ch, c in data["coeff"].items()})
+    os.replace(tmp, entry)
+    # remove least recently used entries, other processes may remove them at the same time
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(".npz") and ".tmp" not in name:
+            try:
+                info = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((info.st_mtime, info.st_size, name))
+    entries.sort()
+    total = sum(size for mtime, size, name in entries)
+    removed = set()
+    for mtime, size, name in entries:
+        if total <= max_size:
+            break
+        if name == key[2] + ".npz":
+            continue
+        total -= size
+        removed.add(name[:-4])
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+    if removed:  # also paths of entries removed by other processes
+        index = read_json(index_file)
+        write_json(index_file, {path: key for path, key in index.items()
+                                if key[2] not in removed and os.path.isfile(os.path.join(directory, key[2] + ".npz"))})
+    return data
+
+
+def select_orbitals(data, orbitals):
+    '''Return list of (orbital, l, column) for orbital names such as ["5d", "6s"] or "all"'''
+    if orbitals == "all":
+        selected = []
+        for ch, l in orbital_dic.items():
+            if ch in data["coeff"]:
+                for column in range(1, data["coeff"][ch].shape[1] + 1):
+                    selected.append((str(column + l) + ch.lower(), l, column))
+        return selected
+    selected = []
+    for orbital in orbitals:
+        orbital_n = int(orbital[:-1])  # The main quantum number of orbital you input
+        orbital_ch = orbital[-1].upper()  # The angular quantum number of orbital you input
+        if orbital_ch not in orbital_dic:
+            print("The orbital you input is not correct.")
+            sys.exit()
+        orbital_l = orbital_dic[orbital_ch] # The angular quantum number of orbital you input
         column = orbital_n - orbital_l
-        line_coeff=int(line2.split('\n')[1])
-        s_index = [i for i in range(len(orbitals)) if orbitals[i] == orbital_ch]
-        z=[basis[i] for i in s_index]
-        N=[mainquantumnumber[i] for i in s_index]
-        if column < 5:
-            for i in range(len(z)):
-                c.append(float(lines[line_coeff+6+i].split()[column]))
+        if orbital_ch not in data["coeff"] or not 0 < column <= data["coeff"][orbital_ch].shape[1]:
+            print("The coefficients of orbital %s are not found." % orbital)
+            sys.exit()
+        selected.append((orbital, orbital_l, column))
+    return selected
+
+
+logfac = np.concatenate(([0.0], np.cumsum(np.log(np.arange(1, 171)))))  # log(n!) for n = 0 ... 170
+
+
+def log_factorial(n):
+    '''Return log(n!) of integer array n from precomputed table, or from log-gamma for large n'''
+    n = np.asarray(n)
+    if n.size and n.max() >= len(logfac):
+        return np.vectorize(math.lgamma, otypes=[float])(n + 1.0)
+    return logfac[n]
+
+
+def ao_norm(z, N, log=False):
+    '''Return AO nomalization coefficient b of STO r^(N-1)*exp(-z*r), or log(b) if log is True'''
+    z = np.asarray(z, dtype=float)
+    N = np.asarray(N)
+    logb = (N + 0.5) * np.log(2 * z) - 0.5 * log_factorial(2 * N)
+    return logb if log else np.exp(logb)
+
+
+def sto_integral(z1, N1, z2, N2, k=0):
+    '''Return matrix of integrals of r^(2+k)*chi_i(r)*chi_j(r) over r between normalized STOs
+       chi = b*r^(N-1)*exp(-z*r) of two basis sets: (N_i+N_j+k)!/(z_i+z_j)^(N_i+N_j+k+1)*b_i*b_j'''
+    z1, z2 = np.asarray(z1, dtype=float), np.asarray(z2, dtype=float)
+    Nij = np.add.outer(N1, N2) + k
+    if Nij.size and Nij.min() < 0:
+        raise ValueError("<r^%d> diverges for the basis sets." % k)
+    logS = np.add.outer(ao_norm(z1, N1, log=True), ao_norm(z2, N2, log=True)) \
+        + log_factorial(Nij) - (Nij + 1) * np.log(np.add.outer(z1, z2))
+    return np.exp(logS)
+
+
+def mo_norm(z, N, c):
+    '''Return MO nomalization coefficient V of each column of coefficient matrix c'''
+    c = np.reshape(c, (len(z), -1))
+    S = sto_integral(z, N, z, N)  # overlap of AOs
+    return np.einsum('ip,ij,jp->p', c, S, c)
+
+
+def orbital_basis(data, orbital_l, columns):
+    '''Return zeta, N and coefficients (M x len(columns)) of orbitals with angular quantum number l'''
+    index = data["l"] == orbital_l
+    return data["zeta"][index], data["N"][index], data["coeff"]["SPDF"[orbital_l]][:, np.asarray(columns) - 1]
+
+
+def calc_moments(data, selected, k):
+    '''Return <r^k> (bohr^k) of selected orbitals for each k (len(k) x norb) without radial grid'''
+    moments = np.empty((len(k), len(selected)))
+    for l in orbital_dic.values():
+        rows = [i for i in range(len(selected)) if selected[i][1] == l]
+        if rows:
+            z, N, c = orbital_basis(data, l, [selected[i][2] for i in rows])
+            V = mo_norm(z, N, c)
+            for j in range(len(k)):
+                moments[j, rows] = np.einsum('ip,ij,jp->p', c, sto_integral(z, N, z, N, k[j]), c) / V
+    return moments
+
+
+def calc_overlaps(data1, data2, selected):
+    '''Return overlap <phi1|phi2> of selected orbitals of data1 with the same orbitals of data2,
+       such as orbitals of different charge states or elements'''
+    selected2 = select_orbitals(data2, [s[0] for s in selected])
+    S = np.empty(len(selected))
+    for i in range(len(selected)):
+        z1, N1, c1 = orbital_basis(data1, selected[i][1], [selected[i][2]])
+        z2, N2, c2 = orbital_basis(data2, selected2[i][1], [selected2[i][2]])
+        S[i] = (c1.T @ sto_integral(z1, N1, z2, N2) @ c2)[0, 0] / np.sqrt(mo_norm(z1, N1, c1)[0] * mo_norm(z2, N2, c2)[0])
+    return S
+
+
+def calc_rdf(z, N, c, r, chunk=65536):
+    '''Return RDF D(r) of MO(s) given by coefficient c (M or M x norb) on radial grid r
+       AO:f1(r)=b*r^(N-1)*exp(-z*r)  MO:f2(r)=sum(c*f1)  D(r)=r^2*f2^2/V'''
+    z = np.asarray(z, dtype=float)[:, None]
+    N = np.asarray(N)
+    r = np.asarray(r, dtype=float)
+    c = np.asarray(c, dtype=float)
+    single = c.ndim == 1
+    c = c.reshape(len(z), -1)
+    b = ao_norm(z[:, 0], N)
+    V = mo_norm(z[:, 0], N, c)
+    D_r = np.empty((c.shape[1], len(r)))
+    # build basis matrix (M x chunk) once per chunk and contract it with all coefficients
+    for start in range(0, len(r), chunk):
+        rr = r[start:start + chunk]
+        chi = b[:, None] * np.power(rr, (N - 1)[:, None]) * np.exp(-z * rr)
+        R = c.T @ chi
+        D_r[:, start:start + chunk] = rr**2 * R**2 / V[:, None]
+    return D_r[0] if single else D_r
+
+
+def calc_orbitals(data, selected, r):
+    '''Return RDF of all selected orbitals (norb x grid), basis matrix is evaluated once for each l'''
+    D_r = np.empty((len(selected), len(r)))
+    for l in orbital_dic.values():
+        rows = [i for i in range(len(selected)) if selected[i][1] == l]
+        if rows:
+            z, N, c = orbital_basis(data, l, [selected[i][2] for i in rows])
+            D_r[rows] = calc_rdf(z, N, c, r)
+    return D_r
+
+
+def simpson_weights(n, h):
+    '''Return composite Simpson weights of n equally spaced points with spacing h'''
+    w = np.zeros(n)
+    m = n - 1 if n % 2 == 0 else n  # odd number of points for Simpson rule
+    w[0:m-1:2] += h / 3
+    w[1:m:2] += 4 * h / 3
+    w[2:m:2] += h / 3
+    if m < n:  # trapezoid rule for the last interval
+        w[-2:] += h / 2
+    return w
+
+
+def uniform_grid(grid, rmax):
+    '''Return uniform radial grid r = m*rmax/grid and its quadrature weights'''
+    r = np.arange(grid) / (grid / rmax)
+    return r, simpson_weights(grid, rmax / grid)
+
+
+def log_grid(grid, rmax, rmin=1e-4):
+    '''Return logarithmic radial grid from rmin to rmax and its quadrature weights (Simpson rule in ln(r))'''
+    x = np.linspace(np.log(rmin), np.log(rmax), grid)
+    r = np.exp(x)
+    return r, simpson_weights(grid, x[1] - x[0]) * r
+
+
+def adaptive_grid(func, rmax, tol=1e-6, rmin=1e-4, n0=32, maxiter=40):
+    '''Return radial grid refined where func(r) (norb x grid) changes quickly, values of func
+       on the grid and its quadrature weights. Intervals are bisected until Simpson rule on the
+       interval and on its two halves differ by less than 15*tol*(interval/rmax) for all orbitals'''
+    edges = np.concatenate(([0], np.geomspace(rmin, rmax, n0)))
+    x = np.stack((edges[:-1], (edges[:-1] + edges[1:]) / 2, edges[1:]))  # lo, mid, hi of intervals
+    f = func(x.ravel()).reshape(-1, 3, n0).transpose(1, 0, 2)
+    done_x, done_f = [], []  # accepted intervals: lo, q1, mid, q3, hi and values
+    for it in range(maxiter):
+        q = np.stack(((x[0] + x[1]) / 2, (x[1] + x[2]) / 2))
+        fq = func(q.ravel()).reshape(-1, 2, q.shape[1]).transpose(1, 0, 2)
+        x5 = np.stack((x[0], q[0], x[1], q[1], x[2]))
+        f5 = np.stack((f[0], fq[0], f[1], fq[1], f[2]))
+        h = x[2] - x[0]
+        S1 = h / 6 * (f[0] + 4 * f[1] + f[2])
+        S2 = h / 12 * (f5[0] + 4 * f5[1] + 2 * f5[2] + 4 * f5[3] + f5[4])
+        err = np.max(np.abs(S2 - S1), axis=0) / 15
+        ok = (err <= tol * h / rmax) | (it == maxiter - 1)
+        done_x.append(x5[:, ok])
+        done_f.append(f5[:, :, ok])
+        bad = ~ok
+        if not bad.any():
+            break
+        # split intervals into two halves: (lo, q1, mid) and (mid, q3, hi)
+        x = np.concatenate((x5[0:3, bad], x5[2:5, bad]), axis=1)
+        f = np.concatenate((f5[0:3, :, bad], f5[2:5, :, bad]), axis=2)
+    x5 = np.concatenate(done_x, axis=1)
+    f5 = np.concatenate(done_f, axis=2)
+    # merge points of all intervals into one sorted grid with composite Simpson weights
+    r, index, inverse = np.unique(x5.ravel(), return_index=True, return_inverse=True)
+    h = x5[4] - x5[0]
+    w = np.zeros(len(r))
+    np.add.at(w, inverse, (np.array([1, 4, 2, 4, 1])[:, None] * h / 12).ravel())
+    D_r = f5.transpose(1, 0, 2).reshape(f5.shape[1], -1)[:, index]
+    return r, D_r, w
+
+
+def radial_extent(func, tol=1e-6, rmax=200):
+    '''Return radius (bohr) beyond which func(r) of all orbitals is negligible'''
+    r = np.geomspace(1e-2, rmax, 400)
+    large = np.nonzero(func(r).max(axis=0) > tol * 1e-2)[0]
+    return min(rmax, r[large[-1]] * 1.2) if len(large) else rmax
+
+
+def rdf_properties(r, w, D_r, func=None):
+    '''Return peak radius r_max, peak height D(r_max), <r> and integral of D(r) of each orbital'''
+    D_r = np.reshape(D_r, (-1, len(r)))
+    norm = D_r @ w
+    r_mean = (D_r * r) @ w / norm
+    # refine peak position with parabola through the three points around maximum
+    i = np.clip(np.argmax(D_r, axis=1), 1, len(r) - 2)
+    rows = np.arange(len(D_r))
+    x0, x1, x2 = r[i - 1], r[i], r[i + 1]
+    y0, y1, y2 = D_r[rows, i - 1], D_r[rows, i], D_r[rows, i + 1]
+    denom = (x1 - x0) * (y1 - y2) - (x1 - x2) * (y1 - y0)
+    shift = 0.5 * ((x1 - x0)**2 * (y1 - y2) - (x1 - x2)**2 * (y1 - y0)) / np.where(denom == 0, 1, denom)
+    r_peak = np.where(denom == 0, x1, np.clip(x1 - shift, x0, x2))
+    peak = np.diagonal(func(r_peak)) if func is not None else y1
+    return r_peak, peak, r_mean, norm
+
+
+def write_rdf(file_name, r, D_r, names=None, chunk=65536):
+    '''Write r (Angstrom) and D(r) of one or several orbitals into file'''
+    table = np.vstack((np.asarray(r) * bohr2A, np.reshape(D_r, (-1, len(r))))).T
+    row = "{:^10.6f}" * table.shape[1] + "\n"
+    with open(file_name, 'w') as f:
+        if names is not None:
+            f.write("#" + "{:^9s}".format("r(A)") + "".join(map("{:^10s}".format, names)) + "\n")
+        for start in range(0, len(table), chunk):
+            block = table[start:start + chunk]
+            f.write((row * len(block)).format(*block.ravel()))
+
+
+def write_npz(file_name, r, D_r, names, data, **meta):
+    '''Write r (bohr), D(r) of all orbitals (norb x grid), basis sets, coefficients and metadata
+       into one uncompressed npz file, which can be memory-mapped by load_rdf'''
+    arrays = {"r": np.asarray(r, dtype=float), "D_r": np.reshape(D_r, (-1, len(r))),
+              "orbitals": np.array(names), "zeta": data["zeta"], "N": data["N"], "l": data["l"]}
+    for ch, c in data["coeff"].items():
+        arrays["coeff_" + ch] = c
+    for key, value in meta.items():
+        arrays[key] = np.asarray(value)
+    np.savez(file_name, **arrays)
+
+
+def load_rdf(file_name):
+    '''Return dictionary of arrays of npz file written by write_npz, memory-mapped without copying'''
+    arrays = {}
+    with zipfile.ZipFile(file_name) as zf, open(file_name, 'rb') as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:  # compressed array can not be memory-mapped
+                arrays[info.filename[:-4]] = np.load(zf.open(info))
+                continue
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            arrays[info.filename[:-4]] = np.memmap(f, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                                   order='F' if fortran_order else 'C')
+    return arrays
+
+
+elements = """H He Li Be B C N O F Ne Na Mg Al Si P S Cl Ar K Ca Sc Ti V Cr Mn Fe Co Ni Cu Zn Ga Ge As Se Br Kr
+Rb Sr Y Zr Nb Mo Tc Ru Rh Pd Ag Cd In Sn Sb Te I Xe Cs Ba La Ce Pr Nd Pm Sm Eu Gd Tb Dy Ho Er Tm Yb Lu
+Hf Ta W Re Os Ir Pt Au Hg Tl Pb Bi Po At Rn Fr Ra Ac Th Pa U Np Pu Am Cm Bk Cf Es Fm Md No Lr
+Rf Db Sg Bh Hs Mt Ds Rg Cn Nh Fl Mc Lv Ts Og""".split()
+
+
+def real_harmonic(l, x, y, z, r):
+    '''Return real spherical harmonic of component S, P:y, D:xz or F:xyz (l = 0, 1, 2, 3)'''
+    r = np.where(r == 0, 1, r)
+    if l == 0:
+        return np.full(np.broadcast(x, y, z).shape, 0.5 / np.sqrt(np.pi))
+    elif l == 1:
+        return np.sqrt(3 / (4 * np.pi)) * np.broadcast_to(y, r.shape) / r
+    elif l == 2:
+        return np.sqrt(15 / (4 * np.pi)) * x * z / r**2
+    return np.sqrt(105 / (4 * np.pi)) * x * y * z / r**3
+
+
+def write_cube(file_name, data, orbital, element="X", npoints=100, extent=8.0, density=False, chunk=1 << 20):
+    '''Write orbital (or its density) on npoints^3 grid from -extent to extent bohr into Gaussian cube file,
+       the grid is evaluated and written in chunks of planes with about chunk points'''
+    orbital, orbital_l, column = select_orbitals(data, [orbital])[0]
+    z, N, c = orbital_basis(data, orbital_l, [column])
+    bc = ao_norm(z, N) * c[:, 0] / np.sqrt(mo_norm(z, N, c)[0])  # normalized MO coefficients of STOs
+    axis = np.linspace(-extent, extent, npoints)
+    h = axis[1] - axis[0]
+    Z = elements.index(element) + 1 if element in elements else 0
+    row = (" %12.5E" * 6 + "\n") * (npoints // 6) + ((" %12.5E" * (npoints % 6) + "\n") if npoints % 6 else "")
+    nplane = max(1, chunk // npoints**2)
+    with open(file_name, 'w') as f:
+        f.write("%s %s generated by RDF_analysis.py\n" % (element, orbital))
+        f.write("%s of orbital %s\n" % ("Density" if density else "Wavefunction", orbital))
+        f.write("%5d %12.6f %12.6f %12.6f\n" % (1, -extent, -extent, -extent))
+        for i in range(3):
+            f.write("%5d %12.6f %12.6f %12.6f\n" % ((npoints,) + tuple(h * (np.arange(3) == i))))
+        f.write("%5d %12.6f %12.6f %12.6f %12.6f\n" % (Z, Z, 0, 0, 0))
+        for start in range(0, npoints, nplane):
+            x = axis[start:start + nplane, None, None]
+            y = axis[None, :, None]
+            zz = axis[None, None, :]
+            r = np.sqrt(x**2 + y**2 + zz**2)
+            R = np.zeros(r.shape)
+            for i in range(len(z)):  # radial part: sum(c*b*r^(N-1)*exp(-z*r))
+                R += bc[i] * r**(N[i] - 1) * np.exp(-z[i] * r)
+            psi = R * real_harmonic(orbital_l, x, y, zz, r)
+            if density:
+                psi = psi**2
+            f.write((row * (psi.shape[0] * npoints)) % tuple(psi.ravel()))
+
+
+def analyse_file(file_name, orbital, args, verbose=True):
+    '''Calculate RDF of orbital(s) from output file of ADF with options args, write RDF file and
+       return summary rows (label, orbital, r_max(A), <r>(A), D(r_max))'''
+    ## 1. Extract (basis "z", coefficient "c", mainquantumnumber "N" from output file of ADF
+    data = read_adf(file_name) if args.no_cache else read_adf_cached(file_name, max_size=args.cache_size * 2**20)
+    selected = select_orbitals(data, orbital if orbital == "all" else orbital.split(","))
+    label = os.path.basename(file_name).split(".", 1)[1]
+
+    ####################################################################################
+    # 2. Calculate RDF of specified atom and orbital
+    ####################################################################################
+    k = [int(i) for i in args.moments.split(",")]
+    moments = calc_moments(data, selected, k)
+    if verbose:
+        print("{:^8s}".format("orbital") + "".join("{:^12s}".format("<r^%d>" % i) for i in k))
+        for i in range(len(selected)):
+            print("{:^8s}".format(selected[i][0]) + "".join("{:^12.6f}".format(m) for m in moments[:, i]))
+    if args.overlap:
+        S = calc_overlaps(data, read_adf(args.overlap), selected)
+        for i in range(len(selected)):
+            print("Overlap of %s between %s and %s: %f" % (selected[i][0], file_name, args.overlap, S[i]))
+    if args.cube:
+        element = label.split("_")[0]
+        for s in selected:
+            write_cube(label + "_" + s[0] + ".cube", data, s[0], element, args.cube_points, args.cube_extent, args.density)
+            if verbose:
+                print("Cube file of %s is written into %s." % (s[0], label + "_" + s[0] + ".cube"))
+    if args.mode == "analytic":
+        r_mean = calc_moments(data, selected, [1])[0]
+        return [(label, selected[i][0], np.nan, r_mean[i] * bohr2A, np.nan) for i in range(len(selected))]
+
+    func = lambda r: calc_orbitals(data, selected, r)
+    if args.mode == "uniform":
+        r, w = uniform_grid(args.grid, args.rmax or 8)
+        D_r = func(r)
+    else:
+        rmax = args.rmax or radial_extent(func, args.tol)
+        if args.mode == "log":
+            r, w = log_grid(args.grid, rmax)
+            D_r = func(r)
         else:
-            column = column - 4
-            for i in range(len(z)):
-                c.append(float(lines[line_coeff+6+i+len(z)+3].split()[column]))
-
-else:
-    print("The orbital you input is not correct.")
-    sys.exit()
-	
-####################################################################################
-# 2. Calculate RDF of specified atom and orbital
-####################################################################################
-import numpy as np
-import math
+            r, D_r, w = adaptive_grid(func, rmax, args.tol)
+        if verbose:
+            print("%d grid points from 0 to %.3f bohr are used." % (len(r), rmax))
 
+    r_peak, peak, r_mean, norm = rdf_properties(r, w, D_r, func)
+    if verbose:
+        print("{:^8s}{:^12s}{:^12s}{:^12s}{:^12s}".format("orbital", "r_max(A)", "D(r_max)", "<r>(A)", "integral"))
+        for i in range(len(selected)):
+            print("{:^8s}{:^12.6f}{:^12.6f}{:^12.6f}{:^12.6f}".format(selected[i][0], r_peak[i] * bohr2A, peak[i], r_mean[i] * bohr2A, norm[i]))
 
-# z=np.loadtxt('basis.txt')  #sita
-# c=np.loadtxt('coefficient.txt')  #coefficient matrix
-# N=np.loadtxt('mainquantumnumber.txt')  #main quantum number of sita
-M=len(z);
-
-# AO nomalization coefficient
-b=np.zeros(M)
-for i in range(M):
-    b[i]=(2 * z[i])**(N[i] + 0.5) / (math.factorial(2 * N[i]))**0.5
-    
-# MO nomalization coefficient
-V=0
-for i in range(M):
-    for j in range(M):
-        V=V + math.factorial(N[i]+N[j]) * b[i] * b[j] * c[i] * c[j] / (z[i] + z[j]) ** ( N[i] + N[j] + 1)
-
-print(b)
-print(V)
-grid=800        
-D_r=np.zeros(grid)  
-r=np.zeros(grid)    
-for m in range(grid):
-    r[m]= m / 100  # radial variable 
-    sumsum=0;
-    for p in range(M):
-        for q in range(M):
-            sumpq=(1/V)*r[m]**2*c[p]*c[q]*b[p]*b[q]*(r[m]**(N[p]-1)* np.exp(-z[p]*r[m]))*(r[m]**(N[q]-1)* np.exp(-z[q]*r[m]));
-        # AO:f1(r)=r^(N-1)*exp(-z(i,1)*r)  MO:f2(r)=E*sum(C(1,i)*f1)
-        # F(r)=r^2*f2^2
-            sumsum=sumsum+sumpq;
-    D_r[m]=sumsum
+    output = label + ("_" + orbital if len(selected) == 1 else "") + "-RDF"
+    if args.format == "npz":
+        write_npz(output + ".npz", r, D_r, [s[0] for s in selected], data, weights=w, r_max=r_peak, peak=peak,
+                  r_mean=r_mean, integral=norm, moments=moments, k=k, source=file_name, mode=args.mode)
+    elif len(selected) == 1:
+        write_rdf(output + ".dat", r, D_r)
+    else:
+        write_rdf(output + ".dat", r, D_r, [s[0] for s in selected])
+    return [(label, selected[i][0], r_peak[i] * bohr2A, r_mean[i] * bohr2A, peak[i]) for i in range(len(selected))]
 
-bohr2A=0.529
-with open(file_name.split(".")[1] + "_" + orbital + "-RDF.dat", 'w') as f:
-    for i in range(len(r)):
-        f.write("{:^10.6f}{:^10.6f}\n".format(r[i] * bohr2A, D_r[i]))
 
-print("RDF calcuation is finished.")        	
\ No newline at end of file
+def expand_files(file_names, orbital):
+    '''Return list of (file, orbital) from glob patterns such as "out.*", comma separated files, or
+       manifest file "@list.txt" with lines of "file [orbital]"'''
+    jobs = []
+    if file_names.startswith("@"):
+        with open(file_names[1:]) as f:
+            for line in f:
+                words = line.split("#")[0].split()
+                if words:
+                    jobs.append((words[0], words[1] if len(words) > 1 else orbital))
+        return jobs
+    for pattern in file_names.split(","):
+        jobs.extend((name, orbital) for name in (sorted(glob.glob(pattern)) or [pattern]))
+    return jobs
+
+
+def write_summary(file_name, rows):
+    '''Write summary rows of all files and orbitals into file'''
+    with open(file_name, 'w') as f:
+        f.write("{:^10s}{:^8s}{:^8s}{:^12s}{:^12s}{:^12s}\n".format("Element", "Charge", "Orbital", "r_max(A)", "<r>(A)", "D(r_max)"))
+        for label, orbital, r_peak, r_mean, peak in rows:
+            element, charge = (label.split("_", 1) + ["0"])[:2]
+            f.write("{:^10s}{:^8s}{:^8s}{:^12.6f}{:^12.6f}{:^12.6f}\n".format(element, charge, orbital, r_peak, r_mean, peak))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Calculate RDF of specified atom and orbital from output file of ADF")
+    parser.add_argument("file_name", help="output file(s) of ADF, such as out.Os, \"out.*\" or @list.txt")
+    parser.add_argument("orbital", help="orbital(s), such as 5d, 4f,5d,6s,6p or all")
+    parser.add_argument("grid", nargs="?", type=int, default=800, help="number of grid points, default: 800")
+    parser.add_argument("rmax", nargs="?", type=float, default=None, help="radial range in bohr, default: 8 for uniform grid")
+    parser.add_argument("-m", "--mode", choices=["uniform", "log", "adaptive", "analytic"], default="uniform",
+                        help="radial grid, or analytic for moments and overlaps without grid, default: uniform")
+    parser.add_argument("-t", "--tol", type=float, default=1e-6, help="error tolerance of adaptive grid, default: 1e-6")
+    parser.add_argument("-k", "--moments", default="-1,1,2", help="k of analytic moments <r^k>, default: -1,1,2")
+    parser.add_argument("-o", "--overlap", help="output file of ADF of another charge state or element for orbital overlaps")
+    parser.add_argument("--no-cache", action="store_true", help="do not use cache of parsed output files")
+    parser.add_argument("--cache-size", type=float, default=1024, help="maximum size (MB) of cache, default: 1024")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of processes for several files")
+    parser.add_argument("-s", "--summary", default="RDF_summary.dat", help="summary file for several files, default: RDF_summary.dat")
+    parser.add_argument("-c", "--cube", action="store_true", help="write orbitals into Gaussian cube files")
+    parser.add_argument("--cube-points", type=int, default=100, help="number of cube grid points along each axis, default: 100")
+    parser.add_argument("--cube-extent", type=float, default=8, help="cube grid from -extent to extent bohr, default: 8")
+    parser.add_argument("--density", action="store_true", help="write orbital density instead of wavefunction into cube files")
+    parser.add_argument("-f", "--format", choices=["dat", "npz"], default="dat",
+                        help="dat: text file; npz: binary file of r (bohr), D(r), basis sets and metadata, default: dat")
+    args = parser.parse_args()
+
+    jobs = expand_files(args.file_name, args.orbital)
+    if not re.search(r"^@|[*?[,]", args.file_name):  # one file
+        analyse_file(jobs[0][0], jobs[0][1], args)
+    else:
+        with ProcessPoolExecutor(args.jobs) as pool:
+            futures = [pool.submit(analyse_file, file_name, orbital, args, False) for file_name, orbital in jobs]
+            rows = []
+            done = 0
+            for (file_name, orbital), future in zip(jobs, futures):
+                try:
+                    rows.extend(future.result())
+                    done += 1
+                    print("RDF of %s in %s is calculated." % (orbital, file_name))
+                except (Exception, SystemExit) as error:
+                    print("RDF of %s in %s is failed: %r" % (orbital, file_name, error))
+        write_summary(args.summary, rows)
+        print("Summary of %d of %d files is written into %s." % (done, len(jobs), args.summary))
+    print("RDF calcuation is finished.")